@@ -0,0 +1,7 @@
+# one task of an array job: line $TASK of the manifest $1 holds
+# <working directory> <command> <args...>, each quoted for the shell
+TASK="${2:-${SLURM_ARRAY_TASK_ID:-$SGE_TASK_ID}}"
+eval "set -- $(sed -n "${TASK}p" "$1")"
+cd "$1" || exit 1
+shift
+exec "$@"
@@ -1,5 +1,6 @@
 #!
 import os
+import sagasu_core
 
 
 class prasa_run(object):
@@ -12,39 +13,12 @@ class prasa_run(object):
         self.sitesin = str(input("Sites: "))
         self.trials = str(input("How many trials? "))
 
-    def pointless(self):
-        if self.datain.endswith(".hkl" or ".HKL"):
-            self.pointless = (
-                "pointless HKLOUT pointless.mtz HKLIN "
-                + str(self.datain)
-                + " > /dev/null 2>&1"
-            )
-        elif self.datain.endswith(".sca" or ".SCA"):
-            self.pointless = "pointless HKLOUT pointless.mtz SCAIN " + str(
-                self.datain + " > /dev/null 2>&1"
-            )
-        else:
-            print("\nNo data given? Guessing...\n")
-            self.pointless = (
-                f"pointless HKLOUT pointless.mtz HKLIN "
-                + str(self.datain)
-                + " > /dev/null 2>&1"
-            )
-        os.system(str(self.pointless))
-
-    def aimless(self):
-        os.system(
-            """
-aimless HKLIN pointless.mtz HKLOUT aimless.mtz > /dev/null 2>&1 << eof
-ANOMALOUS ON
-eof
-                  """
-        )
-
-    def ctruncate(self):
-        os.system(
-            "ctruncate -hklin aimless.mtz -hklout truncate.mtz -colin '/*/*/[I(+),SIGI(+),I(-),SIGI(-)]' > /dev/null 2>&1"
-        )
+    def prep(self):
+        # merge with iotbx, falling back to pointless/aimless/ctruncate
+        run = sagasu_core.core()
+        run.prasa_datain = self.datain
+        run.get_unit_cell_and_sg()
+        run.prasa_prep()
 
     def afro(self):
         os.system(
@@ -69,9 +43,7 @@ eof
 
 prasa = prasa_run()
 prasa.inputs()
-prasa.pointless()
-prasa.aimless()
-prasa.ctruncate()
+prasa.prep()
 prasa.afro()
 prasa.prasa()
 
@@ -79,8 +51,6 @@ prasa.prasa()
 if __name__ == "__main__":
     prasa = prasa_run()
     prasa.inputs()
-    prasa.pointless()
-    prasa.aimless()
-    prasa.ctruncate()
+    prasa.prep()
     prasa.afro()
     prasa.prasa()
@@ -2,81 +2,253 @@
 # -*- coding: utf-8 -*-
 """
 @author: Chris
+
+Run with no arguments for the interactive prompts, or without a terminal:
+
+sagasu.py --config sagasu.json                   rerun a dataset from its config
+sagasu.py --proj x --data x.mtz --highres 2.5 --lowres 4 --maxsites 20
+          --minsites 5 --ntry 1000 --atom S --backend c
+sagasu.py --batch datasets.txt                   many datasets, one per line
+                                                 (a directory with a sagasu.json
+                                                 or the path of the json)
+
+In batch mode every dataset is prepped and its grid (or the coarse pass of an
+adaptive one) submitted before any is waited on. All of them share one
+analysis pool and one backend of each kind (so --jobs bounds local SHELXD runs
+across the whole batch), adaptive coarse passes are refined next, and each
+dataset is analysed as soon as its own grid is finished. The best cells over
+all of them are ranked together at the end.
 """
 import sagasu_core
+import sagasu_ranking
+import argparse
+import json
 import os
+import sys
 from multiprocessing import Pool
 from halo import Halo
 import time
 
 
-path = os.getcwd()
-print("You are here:", path)
-pool = Pool(os.cpu_count() - 1)
-print("Using ", str(os.cpu_count() - 1), "CPU cores")
-pro_or_ana = str(
-    input(
-        "Would you like to run (p)rocessing and analysis or just (a)nalysis: "
-    ).lower()
-)
+def spinner(text, name):
+    # no animation when the output goes to a log file
+    return Halo(
+        text=text, text_color="green", spinner=name, enabled=sys.stdout.isatty()
+    )
 
 
-if pro_or_ana == "p":
-    run = sagasu_core.core()
-    projname, fa_path, highres, lowres, highsites, lowsites, ntry = run.get_input()
-    run.writepickle()
-    if os.path.exists(os.path.join(path, "inps.pkl")):
-        with Halo(
-            text="\nPrepping Jobs",
-            text_color="green",
-            spinner="pipe",
-        ):
-            run.readpickle()
-            run.prasa_prep()
-            run.shelxd_prep()
-        with Halo(
-            text="\nSubmitting jobs", text_color="green", spinner="monkey",
-        ):
+def process(run):
+    with spinner("\nPrepping Jobs", "pipe"):
+        run.prasa_prep()
+        run.shelxd_prep()
+    with spinner("\nSubmitting jobs", "monkey"):
+        if run.adaptive == "y":
+            run.run_sagasu_coarse()
+        else:
             run.run_sagasu_proc()
-        with Halo(
-            text="\nJobs are running, please be patient and watch the shark",
-            text_color="green",
-            spinner="shark",
-        ):
-            run.drmaa2_check()
-    else:
-        pass
 
-if pro_or_ana == "a" or "p":
+
+def refine(run):
+    # adaptive runs: see the coarse pass through, then submit the refinement
+    with spinner("\nCoarse pass running", "shark"):
+        run.check_jobs()
+    with spinner("\nSubmitting the refinement", "monkey"):
+        run.refine_adaptive()
+
+
+def wait(run, pool):
+    if run.coarse:
+        refine(run)
+    with spinner("\nJobs are running, please be patient and watch the shark", "shark"):
+        run.check_jobs(on_done=run.parse_when_done(pool))
+    return run.parsing
+
+
+def analyse(run, pool, parsing=None):
+    to_run, to_run_prasa = run.cleanup_prev()
+    with spinner("\nPulling out the important stuff", "dots12"):
+        parsed, updated = run.gather_results(pool, to_run, parsing)
+        run.write_results(parsed)
+        prasa = run.prasa_table(pool, to_run_prasa)
+    trials = run.load_results()
+    with spinner("\nLooking for outliers", "toggle"):
+        ccall, ccweak, cfom = run.write_summaries(
+            *sagasu_core.mad_outliers(trials), sagasu_core.cfom_patfom(trials)
+        )
+        run.vectoroutliers(trials)
+        hits = run.tophits(ccall, ccweak, cfom)
+        ranking = run.rank_solutions(ccall, ccweak, cfom, prasa)
+        pdb_files, to_run_emma = run.get_filenames_for_emma(ranking)
+        run.emma_correlation_plot(pdb_files, run.emma_comparisons(pool, to_run_emma))
+    with spinner("\nGenerating pretty pictures", "pong"):
+        figures = run.plot_ML(pool, trials, updated, ranking)
+        run.writehtml(hits, ranking, figures)
+    print("\nRun 'firefox sagasu.html' to view results")
+
+
+def load_dataset(entry):
+    # a dataset directory holding sagasu.json, or the json itself
+    entry = os.path.abspath(entry)
     run = sagasu_core.core()
-    if os.path.exists(os.path.join(path, "inps.pkl")):
-        run.readpickle()
-        to_run, to_run_prasa = run.cleanup_prev()
-        with Halo(
-            text="\nPulling out the important stuff",
-            text_color="green",
-            spinner="dots12",
-        ):
-            pool.starmap(run.results, to_run)
-            #pool.starmap(run.prasa_results, to_run_prasa)
-        #run.prasa_results_concurrent()
-        ccoutliers_torun = run.run_sagasu_analysis()
-        with Halo(text="\nLooking for outliers", text_color="green", spinner="toggle"):
-            pool.starmap(run.ccalloutliers, ccoutliers_torun)
-            pool.starmap(run.ccweakoutliers, ccoutliers_torun)
-            pool.starmap(run.CFOM_PATFOM_analysis, ccoutliers_torun)
-            #to_run_emma = run.get_filenames_for_emma()
-            #emma_results = pool.starmap(run.run_emma, to_run_emma) # uncomment for local
-            #run.run_emma_cluster(to_run_emma) # uncomment for cluster
-            #run.emma_correlation_plot(emma_results) # uncomment for local
-            run.vectoroutliers()
-            run.tophits()
-        with Halo(
-            text="\nGenerating pretty pictures", text_color="green", spinner="pong"
-        ):
-            to_run_ML = run.for_ML_analysis()
-            pool.starmap(run.plot_for_ML, to_run_ML)
-            run.writehtml()
-        print("\nRun 'firefox sagasu.html' to view results")
+    run.path = entry if os.path.isdir(entry) else os.path.dirname(entry)
+    if os.path.isdir(entry):
+        run.readconfig()
+    else:
+        with open(entry) as f:
+            run.setconfig(json.load(f))
+    return run
+
+
+def batch(entries, pool, args):
+    runs = [load_dataset(entry) for entry in entries]
+    # one backend per kind, built like core.get_backend so local runs share
+    # the cores out between SHELXD threads
+    backends = {}
+    for run in runs:
+        if args.backend:
+            run.clust = args.backend
+        run.local_jobs = args.jobs
+        if run.clust not in backends:
+            backends[run.clust] = run.get_backend()
+        run.backend = backends[run.clust]
+        run.plot_dpi = args.dpi
+        run.plot_mode = args.plots
+    start = time.time()
+    # one bad dataset should not cost the rest of the shift. Datasets are
+    # told apart by directory, two of them may share a projname
+    failed = []
+
+    def attempt(run, step):
+        os.chdir(run.path)
+        try:
+            step(run)
+        except Exception as e:
+            print(f"\n{run.projname} ({run.path}) failed: {e}")
+            failed.append(run.path)
+
+    if not args.analysis_only:
+        for run in runs:
+            print(f"\n{run.projname}: prepping and submitting in {run.path}")
+            attempt(run, process)
+        # every adaptive coarse pass is refined before any dataset is
+        # waited on to the end
+        for run in runs:
+            if run.coarse and run.path not in failed:
+                attempt(run, refine)
+
+    def finish(run):
+        parsing = {} if args.analysis_only else wait(run, pool)
+        print(f"\n{run.projname}: analysing")
+        analyse(run, pool, parsing)
+
+    for run in runs:
+        if run.path not in failed:
+            attempt(run, finish)
+    print(
+        f"\n{len(runs) - len(failed)} of {len(runs)} datasets done in "
+        f"{(time.time() - start) / 60:.1f} min"
+    )
+    if failed:
+        print("Failed: " + ", ".join(failed))
+    done = [run.path for run in runs if run.path not in failed]
+    if len(done) > 1:
+        print("\nBest cells over the batch:")
+        print(sagasu_ranking.rank_datasets(done).to_string(index=False))
+    return not failed
+
+
+def interactive(pool):
+    path = os.getcwd()
+    print("You are here:", path)
+    parsing = {}
+    pro_or_ana = str(
+        input(
+            "Would you like to run (p)rocessing and analysis or just (a)nalysis: "
+        ).lower()
+    )
+
+    if pro_or_ana == "p":
+        run = sagasu_core.core()
+        projname, fa_path, highres, lowres, highsites, lowsites, ntry = run.get_input()
+        if run.has_config():
+            run.readconfig()
+            process(run)
+            parsing = wait(run, pool)
+        else:
+            pass
+
+    if pro_or_ana == "a" or "p":
+        run = sagasu_core.core()
+        if run.has_config():
+            run.readconfig()
+            analyse(run, pool, parsing)
+        else:
+            print("No previous run found!")
+
+
+def arguments():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--config", help="sagasu.json of a previous or prepared run")
+    parser.add_argument("--batch", help="file listing one dataset per line")
+    parser.add_argument("--proj", help="name of project")
+    parser.add_argument("--data", help="HKL/mtz/sca input file")
+    parser.add_argument("--highres", type=float, help="high resolution cutoff")
+    parser.add_argument("--lowres", type=float, help="low resolution cutoff")
+    parser.add_argument("--maxsites", type=int, help="maximum number of sites")
+    parser.add_argument("--minsites", type=int, help="minimum number of sites")
+    parser.add_argument("--ntry", type=int, help="number of trials")
+    parser.add_argument("--atom", help="anomalous scatterer")
+    parser.add_argument("--cell", help="unit cell, if it is not in the data file")
+    parser.add_argument("--sg", help="space group, if it is not in the data file")
+    parser.add_argument(
+        "--backend", choices=["c", "s", "r", "l"], help="cluster, slurm, rest, local"
+    )
+    parser.add_argument("--adaptive", action="store_true", help="coarse pass first")
+    parser.add_argument("--stop", type=float, help="stop at this many MADs out")
+    parser.add_argument(
+        "--analysis-only", action="store_true", help="skip prep and SHELXD"
+    )
+    parser.add_argument("--jobs", type=int, help="SHELXD runs at once on (l)ocal")
+    parser.add_argument("--dpi", type=int, default=100, help="figure resolution")
+    parser.add_argument(
+        "--plots",
+        choices=["lazy", "cells", "tiled", "both"],
+        default="lazy",
+        help="only the explorer page, a figure per cell, one tiled figure, or both",
+    )
+    parser.add_argument(
+        "--nproc", type=int, default=os.cpu_count() - 1, help="analysis processes"
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    parser = arguments()
+    args = parser.parse_args()
+    pool = Pool(args.nproc)
+    print("Using ", str(args.nproc), "CPU cores")
+    if args.batch:
+        with open(args.batch) as f:
+            entries = [
+                line.strip() for line in f if line.strip() and not line.startswith("#")
+            ]
+        ok = batch(entries, pool, args)
+    elif args.config:
+        ok = batch([args.config], pool, args)
+    elif args.proj:
+        required = ["data", "highres", "lowres", "maxsites", "minsites", "ntry", "atom"]
+        missing = ["--" + name for name in required if getattr(args, name) is None]
+        if missing:
+            parser.error("missing " + " ".join(missing))
+        run = sagasu_core.core()
+        run.config_from_args(
+            argparse.Namespace(**dict(vars(args), backend=args.backend or "l"))
+        )
+        ok = batch([run.config_file()], pool, args)
     else:
-        print("No previous run found!")
+        interactive(pool)
+        ok = True
+    pool.close()
+    sys.exit(0 if ok else 1)
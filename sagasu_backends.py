@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Job backends for sagasu. Jobs are described by a plain dict using the DRMAA2
+template names (job_name, remote_command, args, min_slots, max_slots,
+working_directory) and every backend can submit, poll, cancel and report the
+exit status of them. poll() always answers with one of JOB_STATES.
+
+submit_array() sends a whole grid as one array job: the spec runs
+array_task.sh with a manifest, and each task finds its line of the manifest
+from the scheduler's task index. It returns one handle per task so the tasks
+are polled like any other job.
+"""
+import json
+import os
+import shlex
+import subprocess
+import time
+import urllib.request
+from multiprocessing.pool import ThreadPool
+
+JOB_STATES = ("queued", "running", "done", "failed")
+FINISHED = ("done", "failed")
+
+
+def command_line(spec):
+    return " ".join(
+        shlex.quote(str(a)) for a in [spec["remote_command"]] + list(spec["args"])
+    )
+
+
+class backend:
+    def submit(self, spec):
+        raise NotImplementedError
+
+    def poll(self, job):
+        raise NotImplementedError
+
+    def cancel(self, job):
+        raise NotImplementedError
+
+    def exit_status(self, job):
+        raise NotImplementedError
+
+    def submit_array(self, spec, ntasks):
+        # no scheduler arrays, one job per task with the index as an argument
+        return [
+            self.submit(dict(spec, args=list(spec["args"]) + [str(task)]))
+            for task in range(1, ntasks + 1)
+        ]
+
+
+class drmaa2_backend(backend):
+    # UGE through DRMAA2, as sagasu has always submitted at Diamond
+    def __init__(self, queue="low.q", category="i23_chris", pe="smp"):
+        import drmaa2
+
+        self.drmaa2 = drmaa2
+        self.queue = queue
+        self.category = category
+        self.pe = pe
+        self.session = drmaa2.JobSession()
+
+    def template(self, spec):
+        return self.drmaa2.JobTemplate(
+            dict(
+                spec,
+                job_category=self.category,
+                output_path=spec["working_directory"],
+                error_path=spec["working_directory"],
+                queue_name=self.queue,
+                implementation_specific={"uge_jt_pe": self.pe},
+            )
+        )
+
+    def submit(self, spec):
+        return self.session.run_job(self.template(spec))
+
+    def submit_array(self, spec, ntasks):
+        # a UGE -t 1-ntasks bulk job
+        array = self.session.run_bulk_jobs(self.template(spec), 1, ntasks, 1, ntasks)
+        return array.get_jobs()
+
+    def poll(self, job):
+        state = job.get_state()[0]
+        if state == self.drmaa2.JobState.DONE:
+            return "done"
+        if state == self.drmaa2.JobState.FAILED:
+            return "failed"
+        if state in (self.drmaa2.JobState.RUNNING, self.drmaa2.JobState.SUSPENDED):
+            return "running"
+        return "queued"
+
+    def cancel(self, job):
+        try:
+            job.terminate()
+        except self.drmaa2.Drmaa2Exception:
+            # already finished
+            pass
+
+    def exit_status(self, job):
+        return job.get_info().exit_status
+
+
+# sacct/slurmrestd job states
+SLURM_STATES = {
+    "PENDING": "queued",
+    "REQUEUED": "queued",
+    "CONFIGURING": "queued",
+    "RUNNING": "running",
+    "COMPLETING": "running",
+    "SUSPENDED": "running",
+    "COMPLETED": "done",
+}
+
+
+def slurm_state(state):
+    # anything else (FAILED, CANCELLED, TIMEOUT, OUT_OF_MEMORY...) is a failure
+    return SLURM_STATES.get(state.split()[0].upper(), "failed") if state else "queued"
+
+
+class slurm_sbatch_backend(backend):
+    def __init__(self, partition=None, refresh=10):
+        self.partition = partition
+        # one sacct call per array (or job) and refresh period, not per task
+        self.refresh = refresh
+        self.accounting = {}
+
+    def sbatch(self, spec, *extra):
+        command = [
+            "sbatch",
+            "--parsable",
+            "--job-name=" + spec["job_name"],
+            "--chdir=" + spec["working_directory"],
+            "--cpus-per-task=" + str(spec["max_slots"]),
+        ] + list(extra)
+        if self.partition:
+            command.append("--partition=" + self.partition)
+        command.append("--wrap=" + command_line(spec))
+        out = subprocess.run(command, capture_output=True, text=True, check=True)
+        return out.stdout.strip().split(";")[0]
+
+    def submit(self, spec):
+        return self.sbatch(spec, "--output=%x.o%j", "--error=%x.e%j")
+
+    def submit_array(self, spec, ntasks):
+        jobid = self.sbatch(
+            spec, "--array=1-" + str(ntasks), "--output=%x.o%A_%a", "--error=%x.e%A_%a"
+        )
+        return [jobid + "_" + str(task) for task in range(1, ntasks + 1)]
+
+    def sacct(self, job):
+        parent = str(job).split("_")[0]
+        fetched, rows = self.accounting.get(parent, (0, {}))
+        if time.time() - fetched > self.refresh:
+            out = subprocess.run(
+                ["sacct", "-j", parent, "-X", "-n", "-P", "-o", "JobID,State,ExitCode"],
+                capture_output=True,
+                text=True,
+            )
+            rows = {}
+            for line in out.stdout.strip().splitlines():
+                jobid, state, code = line.split("|")
+                rows[jobid] = (state, code)
+            self.accounting[parent] = (time.time(), rows)
+        return rows.get(str(job), ("", ""))
+
+    def poll(self, job):
+        return slurm_state(self.sacct(job)[0])
+
+    def cancel(self, job):
+        subprocess.run(["scancel", str(job)])
+
+    def exit_status(self, job):
+        code = self.sacct(job)[1]
+        return int(code.split(":")[0]) if code else None
+
+
+class slurm_rest_backend(backend):
+    # slurmrestd with a JWT, eg. from slurmwilson.get_slurm_token(), so no ssh
+    # round trip is needed per job
+    def __init__(
+        self, url, user=None, token=None, partition=None, api="v0.0.39", refresh=10
+    ):
+        if token is None:
+            from slurmwilson import get_slurm_token
+
+            user, token = get_slurm_token()
+        if token is None:
+            raise RuntimeError(
+                f"No Slurm token for {user}, is 'scontrol token' allowed on wilson?"
+            )
+        self.url = url.rstrip("/") + "/slurm/" + api
+        self.headers = {
+            "X-SLURM-USER-NAME": user,
+            "X-SLURM-USER-TOKEN": token,
+            "Content-Type": "application/json",
+        }
+        self.partition = partition
+        self.refresh = refresh
+        self.cache = {}
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(
+            self.url + path, data=data, headers=self.headers, method=method
+        )
+        with urllib.request.urlopen(req) as response:
+            return json.loads(response.read() or b"{}")
+
+    def submit(self, spec):
+        workdir = spec["working_directory"]
+        job = {
+            "name": spec["job_name"],
+            "current_working_directory": workdir,
+            "standard_output": os.path.join(workdir, spec["job_name"] + ".o%j"),
+            "standard_error": os.path.join(workdir, spec["job_name"] + ".e%j"),
+            "cpus_per_task": spec["max_slots"],
+            "environment": ["PATH=/bin:/usr/bin:/usr/local/bin"],
+        }
+        if self.partition:
+            job["partition"] = self.partition
+        if "array" in spec:
+            job["array"] = spec["array"]
+            job["standard_output"] = os.path.join(workdir, spec["job_name"] + ".o%A_%a")
+            job["standard_error"] = os.path.join(workdir, spec["job_name"] + ".e%A_%a")
+        script = "#!/bin/bash\n" + command_line(spec)
+        return self.request("POST", "/job/submit", {"job": job, "script": script})[
+            "job_id"
+        ]
+
+    def submit_array(self, spec, ntasks):
+        jobid = self.submit(dict(spec, array="1-" + str(ntasks)))
+        return [str(jobid) + "_" + str(task) for task in range(1, ntasks + 1)]
+
+    def job(self, job):
+        # array tasks are looked up through their parent, once per refresh
+        parent, _, task = str(job).partition("_")
+        fetched, jobs = self.cache.get(parent, (0, []))
+        if time.time() - fetched > self.refresh:
+            jobs = self.request("GET", "/job/" + parent)["jobs"]
+            self.cache[parent] = (time.time(), jobs)
+        for entry in jobs:
+            number = entry.get("array_task_id")
+            if isinstance(number, dict):
+                number = number.get("number")
+            if not task or str(number) == task:
+                return entry
+        return {"job_state": "PENDING"}
+
+    def poll(self, job):
+        state = self.job(job)["job_state"]
+        # newer API versions report a list of flags
+        return slurm_state(state[0] if isinstance(state, list) else state)
+
+    def cancel(self, job):
+        self.request("DELETE", "/job/" + str(job))
+
+    def exit_status(self, job):
+        code = self.job(job).get("exit_code")
+        # a plain int, or nested {"number": ...} objects in newer API versions
+        while isinstance(code, dict):
+            code = code.get("return_code", code.get("number"))
+        return code
+
+
+class local_job:
+    def __init__(self, spec):
+        self.spec = spec
+        self.state = "queued"
+        self.proc = None
+        self.returncode = None
+
+    def run(self):
+        if self.state != "queued":
+            return
+        self.state = "running"
+        try:
+            self.proc = subprocess.Popen(
+                [self.spec["remote_command"]] + [str(a) for a in self.spec["args"]],
+                cwd=self.spec["working_directory"],
+                stdout=subprocess.DEVNULL,
+            )
+        except OSError as e:
+            print(f"Could not start {self.spec['remote_command']}: {e}")
+            self.state = "failed"
+            return
+        # a cancel that came in while Popen was starting saw no process to
+        # terminate (it sets the state before it looks at proc)
+        if self.state != "running":
+            self.proc.terminate()
+        self.returncode = self.proc.wait()
+        if self.state == "running":
+            self.state = "done" if self.returncode == 0 else "failed"
+
+
+class local_backend(backend):
+    # a bounded pool on this machine, jobs wait for a free worker and each run
+    # with cwd= rather than a global chdir
+    def __init__(self, jobs=None):
+        self.jobs = jobs or os.cpu_count()
+        self.pool = ThreadPool(self.jobs)
+
+    def submit(self, spec):
+        job = local_job(spec)
+        self.pool.apply_async(job.run)
+        return job
+
+    def poll(self, job):
+        return job.state
+
+    def cancel(self, job):
+        if job.state in FINISHED:
+            return
+        job.state = "failed"
+        if job.proc is not None and job.proc.poll() is None:
+            job.proc.terminate()
+
+    def exit_status(self, job):
+        return job.returncode
+
+
+class fake_backend(backend):
+    # nothing is run, every poll moves a job one state on. Jobs named in fail
+    # end up failed, handy for exercising the monitoring without a cluster
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.submitted = []
+        self.states = {}
+
+    def submit(self, spec):
+        job = len(self.submitted)
+        self.submitted.append(spec)
+        self.states[job] = "queued"
+        return job
+
+    def poll(self, job):
+        state = self.states[job]
+        if state == "queued":
+            self.states[job] = "running"
+        elif state == "running":
+            failed = self.submitted[job]["job_name"] in self.fail
+            self.states[job] = "failed" if failed else "done"
+        return state
+
+    def cancel(self, job):
+        if self.states[job] not in FINISHED:
+            self.states[job] = "failed"
+
+    def exit_status(self, job):
+        return {"done": 0, "failed": 1}.get(self.states[job])
+
+
+def make_backend(clust, local_jobs=None):
+    # c - DRMAA2/UGE, s - Slurm sbatch, r - slurmrestd, l - this machine
+    if clust == "c":
+        return drmaa2_backend()
+    if clust == "s":
+        return slurm_sbatch_backend(os.environ.get("SAGASU_SLURM_PARTITION"))
+    if clust == "r":
+        return slurm_rest_backend(
+            os.environ.get("SAGASU_SLURMRESTD", "http://wilson:6820"),
+            partition=os.environ.get("SAGASU_SLURM_PARTITION"),
+        )
+    if clust == "l":
+        return local_backend(local_jobs)
+    raise ValueError("unknown backend " + str(clust))
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Timings for the sagasu analysis and local SHELXD stages
+
+python sagasu_benchmark.py mad --res 40 --sites 20 --ntry 10000
+python sagasu_benchmark.py local --proj myproj --threads 4 8
+python sagasu_benchmark.py plots --res 20 --sites 10 --dpi 100
+python sagasu_benchmark.py rank --res 400 --sites 200
+"""
+
+import argparse
+import ast
+import subprocess
+import textwrap
+import time
+import warnings
+from multiprocessing import Pool
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+import matplotlib
+
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import sagasu_core
+import sagasu_ranking
+
+
+def synthetic_trials(nres, nsites, ntry, seed=0):
+    rng = np.random.default_rng(seed)
+    trials = np.zeros(nres * nsites * ntry, dtype=sagasu_core.TRIALS_DTYPE)
+    trials["RES"] = np.repeat(np.arange(30, 30 + nres), nsites * ntry)
+    trials["SITES"] = np.tile(np.repeat(np.arange(nsites, 0, -1), ntry), nres)
+    trials["TRY"] = np.tile(np.arange(1, ntry + 1), nres * nsites)
+    trials["CCALL"] = rng.normal(20, 3, len(trials)).round(1)
+    trials["CCWEAK"] = rng.normal(10, 2, len(trials)).round(1)
+    # a handful of solutions in one cell
+    hit = (trials["RES"] == 30 + nres // 2) & (trials["SITES"] == nsites // 2)
+    hit &= trials["TRY"] % 100 == 0
+    trials["CCALL"][hit] += 25
+    trials["CCWEAK"][hit] += 12
+    trials["CFOM"] = trials["CCALL"] + trials["CCWEAK"]
+    trials["PATFOM"] = rng.normal(3, 1, len(trials)).round(2)
+    return trials
+
+
+# core.ccalloutliers and core.ccweakoutliers as they were before the grid
+# was batched, taken verbatim from git rather than rewritten here. They read
+# one csv per cell and append their row to <projname>_results/<cc>.csv
+BASELINE_METHODS = ("ccalloutliers", "ccweakoutliers")
+baseline = None
+
+
+def load_baseline(rev):
+    global baseline
+    source = subprocess.run(
+        ["git", "show", rev + ":sagasu_core.py"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    namespace = {"np": np, "pd": pd}
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.FunctionDef) and node.name in BASELINE_METHODS:
+            exec(textwrap.dedent(ast.get_source_segment(source, node)), namespace)
+    baseline = type("baseline", (), {m: namespace[m] for m in BASELINE_METHODS})()
+
+
+def run_baseline(method, projname, filename, resolution, sitessearched):
+    baseline.projname = projname
+    with warnings.catch_warnings():
+        # it takes the median of empty selections, as it always did
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        getattr(baseline, method)(filename, resolution, sitessearched)
+
+
+def first_commit():
+    return subprocess.run(
+        ["git", "rev-list", "--max-parents=0", "HEAD"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.split()[0]
+
+
+def bench_mad(args):
+    trials = synthetic_trials(args.res, args.sites, args.ntry)
+    cells = sagasu_core.split_cells(trials)
+    print(f"{len(cells)} cells, {len(trials)} trials")
+    rev = args.baseline or first_commit()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # the per-cell csv files the old analysis started from, not timed
+        projname = os.path.join(tmp, "bench")
+        os.makedirs(projname + "_results")
+        torun = []
+        for cell, i, j in cells:
+            csvfile = os.path.join(tmp, f"{i}_{j}.csv")
+            frame = pd.DataFrame(cell[sagasu_core.TRY_FIELDS])
+            frame.insert(0, "linebeg", "Try")
+            frame.to_csv(csvfile, header=False, index=False)
+            torun.append((projname, csvfile, i, j))
+
+        start = time.perf_counter()
+        with Pool(args.nproc, initializer=load_baseline, initargs=(rev,)) as pool:
+            for method in BASELINE_METHODS:
+                pool.starmap(run_baseline, [(method,) + cell for cell in torun])
+        legacy = time.perf_counter() - start
+        print(f"{rev[:10]} ccall/ccweakoutliers ({args.nproc} procs): {legacy:.2f} s")
+
+        start = time.perf_counter()
+        new_ccall, new_ccweak = sagasu_core.mad_outliers(trials)
+        batched = time.perf_counter() - start
+        print(f"batched mad_outliers: {batched:.2f} s ({legacy / batched:.1f}x)")
+
+        # rows were appended in whatever order the pool finished them
+        ccall, ccweak = (
+            pd.read_csv(
+                projname + "_results/" + name + ".csv", names=sagasu_ranking.MAD_NAMES
+            )
+            .sort_values(["res", "sites"], ascending=[True, False])
+            .to_numpy()
+            for name in ("ccall", "ccweak")
+        )
+
+    assert np.array_equal(new_ccweak.to_numpy(), ccweak)
+    print("CCweak outlier counts agree")
+    # the old ccalloutliers took its centroid with arr.mean(axis=1), the mean
+    # of the first trial's CCall and CCweak rather than of each column, which
+    # mad_outliers does not copy
+    differ = np.any(new_ccall.to_numpy() != ccall, axis=1).sum()
+    print(f"CCall outlier counts differ in {differ} of {len(ccall)} cells")
+
+    start = time.perf_counter()
+    with Pool(args.nproc) as pool:
+        best = pool.starmap(np.argmax, [(cell["CFOM"],) for cell, i, j in cells])
+    reference = [
+        (i / 10, j, cell["CFOM"][b], cell["PATFOM"][b])
+        for (cell, i, j), b in zip(cells, best)
+    ]
+    legacy = time.perf_counter() - start
+    start = time.perf_counter()
+    cfom = sagasu_core.cfom_patfom(trials)
+    batched = time.perf_counter() - start
+    print(f"CFOM/PATFOM per cell {legacy:.2f} s, batched {batched:.3f} s")
+    assert np.array_equal(cfom.to_numpy(dtype=float), np.array(reference, dtype=float))
+    print("best CFOM and PATFOM agree")
+
+
+# the pyplot figure per cell that plot_cells replaced, it was saved at 500 dpi
+def legacy_plot(cell, filename, dpi=500):
+    plt.scatter(cell["CCWEAK"], cell["CCALL"], marker="o")
+    plt.draw()
+    ccallvsccweak = plt.gcf()
+    ccallvsccweak.savefig(filename, dpi=dpi, bbox_inches=0)
+    ccallvsccweak.clear()
+    plt.close(ccallvsccweak)
+
+
+def bench_plots(args):
+    trials = synthetic_trials(args.res, args.sites, args.ntry)
+    cells = sagasu_core.split_cells(trials)
+    with tempfile.TemporaryDirectory() as tmp:
+        # both backends at the same dpi, the old 500 dpi default on its own
+        timings = {}
+        for dpi in sorted({args.dpi, 500}):
+            start = time.perf_counter()
+            with Pool(args.nproc) as pool:
+                pool.starmap(
+                    legacy_plot,
+                    [
+                        (cell, os.path.join(tmp, f"old_{i}_{j}.png"), dpi)
+                        for cell, i, j in cells
+                    ],
+                )
+            timings[dpi] = time.perf_counter() - start
+            print(f"pyplot per cell at {dpi} dpi: {timings[dpi]:.1f} s")
+        legacy = timings[args.dpi]
+
+        # the workers map the store from disk, as in a real analysis
+        trials_file = os.path.join(tmp, "trials.npy")
+        np.save(trials_file, trials)
+        bounds = list(zip(*sagasu_core.cell_bounds(trials)))
+        labels = [(i, j) for cell, i, j in cells]
+        start = time.perf_counter()
+        batches = [list(range(n, len(cells), args.nproc)) for n in range(args.nproc)]
+        with Pool(args.nproc) as pool:
+            pool.starmap(
+                sagasu_core.plot_cells,
+                [
+                    (
+                        trials_file,
+                        [bounds[n] for n in batch],
+                        [os.path.join(tmp, "new_%d_%d.png" % labels[n]) for n in batch],
+                        args.dpi,
+                    )
+                    for batch in batches
+                ],
+            )
+        batched = time.perf_counter() - start
+        print(
+            f"Agg batches at {args.dpi} dpi: {batched:.1f} s ({legacy / batched:.1f}x)"
+        )
+        if args.dpi != 500:
+            print(f"with 500 -> {args.dpi} dpi as well: {timings[500] / batched:.1f}x")
+
+        start = time.perf_counter()
+        sagasu_core.plot_tiled(cells, os.path.join(tmp, "tiled.png"), args.dpi)
+        print(f"one tiled figure: {time.perf_counter() - start:.1f} s")
+
+
+def bench_rank(args):
+    # summaries of a large grid, ranked the way tophits used to (full sort of
+    # every table) and with the partial top-K
+    rng = np.random.default_rng(0)
+    ncells = args.res * args.sites
+    ccall = pd.DataFrame(
+        rng.poisson(2, (ncells, len(sagasu_ranking.MAD_NAMES))),
+        columns=sagasu_ranking.MAD_NAMES,
+    )
+    ccall["res"] = np.repeat(np.arange(30, 30 + args.res), args.sites) / 10
+    ccall["sites"] = np.tile(np.arange(args.sites, 0, -1), args.res)
+    print(f"{ncells} cells")
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        df = ccall.copy()
+        df["score"] = sagasu_ranking.mad_score(df)
+        df.sort_values(by=["score"], ascending=False, kind="stable", inplace=True)
+        legacy = df.head(10)
+    full = (time.perf_counter() - start) / args.repeat
+    print(f"full sort: {full * 1000:.2f} ms")
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        df = ccall.assign(score=sagasu_ranking.mad_score(ccall))
+        best = sagasu_ranking.top_k(df, "score")
+    partial = (time.perf_counter() - start) / args.repeat
+    print(f"top_k: {partial * 1000:.2f} ms ({full / partial:.1f}x)")
+    assert legacy.index.equals(best.index)
+    print("top 10 agree")
+
+
+def bench_local(args):
+    # needs shelxd on the PATH and <proj>_fa.ins/.hkl from shelxc in the cwd,
+    # the one-at-a-time layout with every core in one SHELXD is the reference
+    here = os.getcwd()
+    cores = os.cpu_count()
+    layouts = [(1, cores)] + [(max(1, cores // t), t) for t in args.threads]
+    for jobs, threads in layouts:
+        run = sagasu_core.core()
+        run.projname = args.proj
+        run.path = os.path.join(here, f"bench_{jobs}x{threads}")
+        os.makedirs(run.path, exist_ok=True)
+        run.insin = os.path.join(here, args.proj + "_fa.ins")
+        run.hklin = os.path.join(here, args.proj + "_fa.hkl")
+        # the .hkl shells need the cell, the shelxc .ins has it
+        run.unitcell = args.cell or sagasu_ranking.res_header(run.insin)["cell"]
+        run.highres = int(10 * args.highres)
+        run.lowres = run.highres + args.res
+        run.highsites = args.maxsites
+        run.lowsites = args.maxsites - args.sites + 1
+        run.ntry = args.ntry
+        run.clust = "l"
+        run.local_threads = threads
+        run.local_jobs = jobs
+        run.poll_interval = 10
+        start = time.perf_counter()
+        run.run_sagasu_proc()
+        run.check_jobs()
+        elapsed = time.perf_counter() - start
+        os.chdir(here)
+        ncells = args.res * args.sites
+        print(
+            f"{jobs} job(s) x {threads} thread(s): {elapsed:.1f} s, "
+            f"{elapsed / ncells:.1f} s per cell"
+        )
+        shutil.rmtree(run.path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest="stage", required=True)
+    mad = sub.add_parser("mad", help="MAD outlier counting")
+    mad.add_argument("--res", type=int, default=40)
+    mad.add_argument("--sites", type=int, default=20)
+    mad.add_argument("--ntry", type=int, default=10000)
+    mad.add_argument("--nproc", type=int, default=max(1, os.cpu_count() - 1))
+    mad.add_argument("--baseline", help="commit to take the old code from (first)")
+    mad.set_defaults(func=bench_mad)
+    plots = sub.add_parser("plots", help="per-cell CCall vs CCweak figures")
+    plots.add_argument("--res", type=int, default=20)
+    plots.add_argument("--sites", type=int, default=10)
+    plots.add_argument("--ntry", type=int, default=1000)
+    plots.add_argument("--dpi", type=int, default=100)
+    plots.add_argument("--nproc", type=int, default=max(1, os.cpu_count() - 1))
+    plots.set_defaults(func=bench_plots)
+    rank = sub.add_parser("rank", help="scoring and top-K of the grid summaries")
+    rank.add_argument("--res", type=int, default=400)
+    rank.add_argument("--sites", type=int, default=200)
+    rank.add_argument("--repeat", type=int, default=20)
+    rank.set_defaults(func=bench_rank)
+    local = sub.add_parser("local", help="local SHELXD scheduling on a sample grid")
+    local.add_argument("--proj", required=True)
+    local.add_argument("--cell", help="unit cell, read from the .ins by default")
+    local.add_argument("--highres", type=float, default=2.5)
+    local.add_argument("--res", type=int, default=4, help="resolution steps")
+    local.add_argument("--maxsites", type=int, default=8)
+    local.add_argument("--sites", type=int, default=4, help="sites steps")
+    local.add_argument("--ntry", type=int, default=200)
+    local.add_argument(
+        "--threads", type=int, nargs="+", default=[4], help="threads per SHELXD"
+    )
+    local.set_defaults(func=bench_local)
+    args = parser.parse_args()
+    args.func(args)
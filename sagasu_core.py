@@ -6,31 +6,694 @@ import csv
 import re
 import pandas as pd
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import seaborn as sns
 import plotly.express as px
+import plotly.graph_objects as go
 import numpy as np
 import pickle
-import glob
 from multiprocessing import Pool
 import shutil
+import shlex
+import tempfile
 from pathlib import Path
 import subprocess
 import time
+import warnings
+import json
+import hashlib
 from iotbx.file_reader import any_file
+from cctbx import crystal
+from cctbx import euclidean_model_matching as emma
+import iotbx.pdb
 from itertools import combinations
 
-
-# import drmaa2
-from drmaa2 import JobSession, JobTemplate, JobInfo, Drmaa2Exception
+import sagasu_backends
+import sagasu_report
+from sagasu_ranking import (
+    MAD_MULTIPLIERS,
+    mad_score,
+    cfom_score,
+    joint_ranking,
+    top_k,
+)
 
 
 sns.set()
 
+# one SHELXD trial summary from <proj>_fa.lst, eg.
+#  Try   12, CPU 3, CC All/Weak  35.2 / 18.3, CFOM  53.5, best  53.5, PATFOM   2.35
+TRY_LINE = re.compile(
+    r"^\s*Try\s*(\d+)\s*,\s*CPU\s*(\d+)\s*,"
+    r"\s*CC\s*All\s*/\s*Weak\s*(-?[\d.]+)\s*/\s*(-?[\d.]+)\s*,"
+    r"\s*CFOM\s*(-?[\d.]+)\s*,\s*best\s*(-?[\d.]+)\s*,\s*PATFOM\s*(-?[\d.]+)"
+)
+# the same line in a .lst that older sagasu versions rewrote in place, with
+# the labels and separators stripped, eg.
+#  Try   12   3   35.2   18.3   53.5   53.5   2.35
+LEGACY_TRY_LINE = re.compile(
+    r"^\s*Try\s+(\d+)\s+(\d+)" + r"\s+(-?[\d.]+)" * 5 + r"\s*$"
+)
+MANIFEST_VERSION = 1
+# End of trial 12: finalCC is 0.3456, CCrange is 0.1234, CCall is 0.4567 (candidate for a solution)
+PRASA_LINE = re.compile(
+    r"^End of trial\s*(\d+)[\s:,]*final\s*CC is\s*(-?[\d.]+)[\s,]*"
+    r"CCrange is\s*(-?[\d.]+)[\s,]*CCall is\s*(-?[\d.]+)\s*(\(candidate)?"
+)
+PRASA_COLUMNS = ["res", "trial", "CC", "CCrange", "CCall", "candidate"]
+# the run-config, <path>/sagasu.json, replaces the positional inps.pkl
+CONFIG_FILE = "sagasu.json"
+CONFIG_VERSION = 1
+CONFIG_FIELDS = {
+    "projname": str,
+    "prasa_datain": str,
+    "fa_path": str,
+    "insin": str,
+    "hklin": str,
+    "atomin": str,
+    "unitcell": str,
+    "spacegroup": str,
+    "highres": int,
+    "lowres": int,
+    "highsites": int,
+    "lowsites": int,
+    "midsites": int,
+    "ntry": int,
+    "clust": str,
+    "clusteranalysis": str,
+    "adaptive": str,
+    "stop_confidence": (int, float, type(None)),
+}
+# fields older configs may not have
+CONFIG_DEFAULTS = {"adaptive": "n", "stop_confidence": None, "clusteranalysis": "y"}
+# order of the fields in the old inps.pkl
+LEGACY_FIELDS = [
+    "projname",
+    "lowres",
+    "highres",
+    "lowsites",
+    "highsites",
+    "ntry",
+    "clusteranalysis",
+    "clust",
+    "insin",
+    "hklin",
+    "atomin",
+    "prasa_datain",
+    "midsites",
+    "unitcell",
+    "spacegroup",
+]
+TRY_FIELDS = ["TRY", "CPUNO", "CCALL", "CCWEAK", "CFOM", "BEST", "PATFOM"]
+# every trial of the whole grid lives in one <proj>_trials.npy with this layout,
+# rows are grouped by cell in the order the grid was parsed
+TRIALS_DTYPE = np.dtype(
+    [("RES", "i4"), ("SITES", "i4"), ("TRY", "i4"), ("CPUNO", "i4")]
+    + [(name, "f8") for name in TRY_FIELDS[2:]]
+)
+
+
+def parse_try(line):
+    match = TRY_LINE.match(line) or LEGACY_TRY_LINE.match(line)
+    if match:
+        trynum, cpu, ccall, ccweak, cfom, best, patfom = match.groups()
+        return (
+            int(trynum),
+            int(cpu),
+            float(ccall),
+            float(ccweak),
+            float(cfom),
+            float(best),
+            float(patfom),
+        )
+
+
+def parse_lst(filename):
+    # streams the .lst once, the SHELXD output itself is never modified
+    with open(filename, "r") as lst:
+        for line in lst:
+            row = parse_try(line)
+            if row:
+                yield row
+
+
+def lst_complete(filename, ntry):
+    # SHELXD got through ntry trials and wrote its closing line, eg.
+    #  +  SHELXD finished at 14:47:19      Total elapsed time:   123.45 secs  +
+    if not os.path.exists(filename):
+        return False
+    with open(filename, "rb") as lst:
+        lst.seek(max(0, os.path.getsize(filename) - 4096))
+        finished = b"finished at" in lst.read()
+    return finished and sum(1 for row in parse_lst(filename)) >= ntry
+
+
+class lst_tail:
+    # follows the .lst of a running cell, only reading what SHELXD has
+    # written since the last call
+    def __init__(self, filename):
+        self.filename = filename
+        self.offset = 0
+        self.partial = ""
+        self.rows = []
+
+    def read(self):
+        try:
+            size = os.path.getsize(self.filename)
+        except OSError:
+            return self.rows
+        if size < self.offset:
+            # the cell has been restarted, start again from the top
+            self.offset, self.partial, self.rows = 0, "", []
+        with open(self.filename, "rb") as lst:
+            lst.seek(self.offset)
+            chunk = self.partial + lst.read().decode("utf-8", "replace")
+            self.offset = lst.tell()
+        lines = chunk.split("\n")
+        self.partial = lines.pop()
+        for line in lines:
+            row = parse_try(line)
+            if row:
+                self.rows.append(row)
+        return self.rows
+
+
+def validate_config(config):
+    # fills in defaults and raises ValueError naming every bad field
+    version = config.get("version", CONFIG_VERSION)
+    if version > CONFIG_VERSION:
+        raise ValueError(f"Run config version {version} is newer than this sagasu")
+    config = dict(CONFIG_DEFAULTS, **config)
+    if "fa_path" not in config and "insin" in config:
+        config["fa_path"] = os.path.dirname(config["insin"])
+    problems = [name + " is missing" for name in CONFIG_FIELDS if name not in config]
+    for name, kind in CONFIG_FIELDS.items():
+        value = config.get(name)
+        if name in config and (isinstance(value, bool) or not isinstance(value, kind)):
+            problems.append(f"{name} has the wrong type ({value!r})")
+    if problems:
+        raise ValueError("Bad run config: " + "; ".join(problems))
+    return dict(
+        version=CONFIG_VERSION, **{name: config[name] for name in CONFIG_FIELDS}
+    )
+
+
+def render_ins(template, overrides):
+    # the shared .ins with whole instruction lines swapped, eg. {"FIND": "FIND 8"}
+    return "".join(
+        overrides[line[:4].upper()] + "\n" if line[:4].upper() in overrides else line
+        for line in template
+    )
+
+
+def link_into(src, dst):
+    # hard link, else symlink, else copy. Returns the bytes actually written
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return 0
+    except OSError:
+        pass
+    try:
+        os.symlink(os.path.abspath(src), dst)
+        return 0
+    except OSError:
+        shutil.copy2(src, dst)
+        return os.path.getsize(dst)
+
+
+def copy_into(src, dst):
+    # a file of its own at dst, whatever dst was linked to before is untouched
+    if os.path.lexists(dst):
+        os.remove(dst)
+    shutil.copy2(src, dst)
+
+
+def read_hkl(filename):
+    # SHELX HKLF 3/4 file: the reflection lines, their indices and the 0 0 0
+    # line that ends them
+    lines, indices, end = [], [], ""
+    with open(filename) as f:
+        for line in f:
+            try:
+                h, k, l = int(line[0:4]), int(line[4:8]), int(line[8:12])
+            except ValueError:
+                continue
+            if h == k == l == 0:
+                end = line
+                break
+            lines.append(line)
+            indices.append((h, k, l))
+    return lines, np.array(indices, dtype=float).reshape(-1, 3), end
+
+
+def d_spacings(indices, unitcell):
+    a, b, c, alpha, beta, gamma = (float(x) for x in unitcell.split())
+    alpha, beta, gamma = np.radians([alpha, beta, gamma])
+    metric = np.array(
+        [
+            [a * a, a * b * np.cos(gamma), a * c * np.cos(beta)],
+            [a * b * np.cos(gamma), b * b, b * c * np.cos(alpha)],
+            [a * c * np.cos(beta), b * c * np.cos(alpha), c * c],
+        ]
+    )
+    inverse = np.linalg.inv(metric)
+    return 1 / np.sqrt(np.einsum("ij,jk,ik->i", indices, inverse, indices))
+
+
+def sorted_hkl(hklin, unitcell):
+    # reflection lines from low to high resolution, ties in file order so a
+    # shell reads the same when reflections are added beyond it
+    lines, indices, end = read_hkl(hklin)
+    d = d_spacings(indices, unitcell)
+    order = np.argsort(-d, kind="stable")
+    return [lines[i] for i in order], d[order], end
+
+
+def write_hkl_shells(hklin, unitcell, shells):
+    # shells maps resolution cutoffs (A) to output files. The reflections are
+    # sorted by resolution once and each file is the low resolution prefix of
+    # that list, so every cell only reads what its SHEL would keep. Files are
+    # replaced, not rewritten, cells still linked to an old shell keep it.
+    lines, d, end = sorted_hkl(hklin, unitcell)
+    written = 0
+    for cutoff, filename in shells.items():
+        keep = np.searchsorted(-d, -cutoff, side="right")
+        with open(filename + ".tmp", "w") as f:
+            f.writelines(lines[:keep])
+            f.write(end)
+        os.replace(filename + ".tmp", filename)
+        written += os.path.getsize(filename)
+    return written
+
+
+def hkl_shell_hashes(hklin, unitcell, cutoffs):
+    # sha256 of what write_hkl_shells would write for each cutoff, in one
+    # pass over the sorted reflections
+    lines, d, end = sorted_hkl(hklin, unitcell)
+    digest = hashlib.sha256()
+    hashes = {}
+    done = 0
+    for cutoff in sorted(cutoffs, reverse=True):
+        keep = np.searchsorted(-d, -cutoff, side="right")
+        for line in lines[done:keep]:
+            digest.update(line.encode())
+        done = keep
+        shell = digest.copy()
+        shell.update(end.encode())
+        hashes[cutoff] = shell.hexdigest()
+    return hashes
+
+
+class prep_cache:
+    # prep products stored under <root>/<key>/ where the key hashes the input
+    # file and every parameter that changes them. Entries are touched when
+    # used and the least recently used go once the cache passes max_bytes.
+    def __init__(self, root=None, max_bytes=None):
+        self.root = root or os.environ.get(
+            "SAGASU_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "sagasu")
+        )
+        if max_bytes is None:
+            max_bytes = float(os.environ.get("SAGASU_CACHE_GB", 5)) * 1e9
+        self.max_bytes = max_bytes
+
+    def key(self, *parts):
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def fetch(self, key, files):
+        # files maps names in the entry to where they are wanted
+        entry = os.path.join(self.root, key)
+        if not all(os.path.exists(os.path.join(entry, name)) for name in files):
+            return False
+        for name, dst in files.items():
+            # copies, not links: prep and shelxc rewrite their products in
+            # place and a shared inode would change the entry under its key
+            copy_into(os.path.join(entry, name), dst)
+        os.utime(entry)
+        return True
+
+    def store(self, key, files):
+        entry = os.path.join(self.root, key)
+        tmp = entry + ".tmp" + str(os.getpid())
+        os.makedirs(tmp, exist_ok=True)
+        for name, src in files.items():
+            copy_into(src, os.path.join(tmp, name))
+        if os.path.exists(entry):
+            shutil.rmtree(entry)
+        os.replace(tmp, entry)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        # least recently used first, never the entry keep (just stored), even
+        # when it alone is over the limit
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.is_dir() and ".tmp" not in entry.name:
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime, size, entry.path))
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if os.path.basename(path) == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+def run_tool(command, stdin=None):
+    # external programs fail loudly instead of leaving missing files behind
+    try:
+        out = subprocess.run(command, input=stdin, capture_output=True, text=True)
+    except FileNotFoundError:
+        raise RuntimeError(f"{command[0]} not found, is ccp4/shelx loaded?")
+    if out.returncode != 0:
+        tail = "\n".join((out.stdout + out.stderr).strip().splitlines()[-10:])
+        raise RuntimeError(f"{command[0]} failed ({out.returncode}):\n{tail}")
+    return out.stdout
+
+
+def pick_intensities(arrays):
+    # anomalous intensities with sigmas first, then any intensities
+    intensities = [
+        a for a in arrays if a.is_xray_intensity_array() and a.sigmas() is not None
+    ]
+    intensities.sort(key=lambda a: not a.anomalous_flag())
+    return intensities[0] if intensities else None
+
+
+def merge_anomalous(i_obs, symmetry):
+    # what pointless/aimless were used for: merged I(+)/I(-) in the asu
+    i_obs = i_obs.customized_copy(crystal_symmetry=symmetry, anomalous_flag=True)
+    i_obs = i_obs.select(i_obs.sigmas() > 0).map_to_asu()
+    if not i_obs.is_unique_set_under_symmetry():
+        i_obs = i_obs.merge_equivalents().array()
+    return i_obs
+
+
+def write_prep_outputs(merged, workdir="."):
+    # aimless.sca for SHELXC, aimless.mtz for the symmetry, and truncate.mtz
+    # with French-Wilson F(+)/F(-) for AFRO in place of ctruncate
+    merged.export_as_scalepack(file_name=os.path.join(workdir, "aimless.sca"))
+    dataset = merged.as_mtz_dataset(column_root_label="I")
+    dataset.mtz_object().write(os.path.join(workdir, "aimless.mtz"))
+    dataset.add_miller_array(merged.french_wilson(), column_root_label="F")
+    dataset.mtz_object().write(os.path.join(workdir, "truncate.mtz"))
+
+
+def parse_prasa(filename, i):
+    # one pass over prasa.txt, a row per finished trial
+    if not os.path.exists(filename):
+        return []
+    rows = []
+    with open(filename, errors="replace") as f:
+        for line in f:
+            match = PRASA_LINE.match(line)
+            if match:
+                trial, cc, ccrange, ccall, candidate = match.groups()
+                rows.append(
+                    (
+                        i / 10,
+                        int(trial),
+                        float(cc),
+                        float(ccrange),
+                        float(ccall),
+                        candidate is not None,
+                    )
+                )
+    return rows
+
+
+def fingerprint(filename):
+    # cheap change detection for outputs, size and modification time
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def file_hash(filename):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def parse_cell(filename, i, j):
+    if not os.path.exists(filename):
+        print(f"No SHELXD output for {i}_{j}, skipping")
+        return np.array([], dtype=TRIALS_DTYPE)
+    rows = [(i, j) + row for row in parse_lst(filename)]
+    if not rows:
+        print(f"No trials found in {filename}, is it a SHELXD .lst?")
+    return np.array(rows, dtype=TRIALS_DTYPE)
+
+
+def cell_bounds(trials):
+    # start/end row of every res/sites cell in the store
+    keys = np.column_stack((trials["RES"], trials["SITES"]))
+    starts = np.flatnonzero(np.any(keys[1:] != keys[:-1], axis=1)) + 1
+    return np.concatenate(([0], starts)), np.concatenate((starts, [len(trials)]))
+
+
+def split_cells(trials):
+    # views into the (memory mapped) store, one per res/sites cell
+    if trials.size == 0:
+        return []
+    return [
+        (trials[a:b], int(trials["RES"][a]), int(trials["SITES"][a]))
+        for a, b in zip(*cell_bounds(trials))
+    ]
+
+
+def mad_outliers(trials, multipliers=MAD_MULTIPLIERS):
+    # CCall and CCweak outlier counts for every cell of the grid at once. Cells
+    # are padded with nan into one (cells, trials, metric) block, trials below
+    # the cell centroid in either CC are dropped and the remainder counted
+    # against k * MAD of the metric for every multiplier k.
+    columns = ["res", "sites"] + ["mad" + str(k) for k in multipliers]
+    if trials.size == 0:
+        return pd.DataFrame(columns=columns), pd.DataFrame(columns=columns)
+    starts, ends = cell_bounds(trials)
+    lengths = ends - starts
+    rows = np.repeat(np.arange(len(starts)), lengths)
+    cols = np.arange(len(trials)) - np.repeat(starts, lengths)
+    block = np.full((len(starts), lengths.max(), 2), np.nan)
+    block[rows, cols, 0] = trials["CCALL"]
+    block[rows, cols, 1] = trials["CCWEAK"]
+    with warnings.catch_warnings():
+        # cells with nothing above the centroid give all-nan slices
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        median = np.nanmedian(block, axis=1)
+        centroid = np.nanmean(block, axis=1)
+        above = np.all(block > centroid[:, None, :], axis=2)
+        dev = np.where(above[:, :, None], block - median[:, None, :], np.nan)
+        mad = np.nanmedian(np.abs(dev), axis=1)
+        counts = np.stack(
+            [(dev > k * mad[:, None, :]).sum(axis=1) for k in multipliers], axis=2
+        )
+    summaries = []
+    for metric in range(2):
+        df = pd.DataFrame(counts[:, metric, :], columns=columns[2:])
+        df.insert(0, "sites", trials["SITES"][starts])
+        df.insert(0, "res", trials["RES"][starts] / 10)
+        summaries.append(df)
+    return summaries[0], summaries[1]
+
+
+def cfom_patfom(trials):
+    # the best CFOM of every cell and the PATFOM of the (first) trial that
+    # has it, in grid order
+    columns = ["res", "sites", "CFOM", "PATFOM"]
+    if trials.size == 0:
+        return pd.DataFrame(columns=columns)
+    starts, ends = cell_bounds(trials)
+    cfom = np.asarray(trials["CFOM"])
+    top = np.maximum.reduceat(cfom, starts)
+    is_top = cfom == np.repeat(top, ends - starts)
+    rows = np.where(is_top, np.arange(len(cfom)), len(cfom))
+    best = np.minimum.reduceat(rows, starts)
+    return pd.DataFrame(
+        {
+            "res": trials["RES"][starts] / 10,
+            "sites": trials["SITES"][starts],
+            "CFOM": top,
+            "PATFOM": trials["PATFOM"][best],
+        },
+        columns=columns,
+    )
+
+
+def vector_outliers(trials):
+    # the vector outliers of every cell at once: trials above the cell mean in
+    # both CCs, weighted by their distance from it (normalised per cell) over
+    # the cube root of the CCall/CCweak imbalance, kept above 0.1
+    columns = ["CCALL", "CCWEAK", "CCALL_VEC", "CCWEAK_VEC", "VEC_DIFF", "COMB_VEC"]
+    columns += ["NORM_VEC_DIFF", "NORM_COMB_VEC", "WEIGHTED", "RES", "SITES"]
+    if trials.size == 0:
+        return pd.DataFrame(columns=columns)
+    starts, ends = cell_bounds(trials)
+    lengths = ends - starts
+    ccall = np.asarray(trials["CCALL"], dtype=float)
+    ccweak = np.asarray(trials["CCWEAK"], dtype=float)
+    ccall_vec = ccall - np.repeat(np.add.reduceat(ccall, starts) / lengths, lengths)
+    ccweak_vec = ccweak - np.repeat(np.add.reduceat(ccweak, starts) / lengths, lengths)
+    above = (ccall_vec > 0) & (ccweak_vec > 0)
+    vec_diff = np.abs(ccall_vec - ccweak_vec)
+    comb_vec = np.sqrt(ccall_vec**2 + ccweak_vec**2)
+    # per-cell maxima over the trials above the mean only
+    max_diff = np.maximum.reduceat(np.where(above, vec_diff, 0), starts)
+    max_comb = np.maximum.reduceat(np.where(above, comb_vec, 0), starts)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        norm_diff = vec_diff / np.repeat(max_diff, lengths) + 0.000001
+        norm_comb = comb_vec / np.repeat(max_comb, lengths) + 0.000001
+        weighted = np.power(norm_comb, 18) / np.cbrt(norm_diff)
+    keep = above & (weighted > 0.1)
+    return pd.DataFrame(
+        {
+            "CCALL": ccall[keep],
+            "CCWEAK": ccweak[keep],
+            "CCALL_VEC": ccall_vec[keep],
+            "CCWEAK_VEC": ccweak_vec[keep],
+            "VEC_DIFF": vec_diff[keep],
+            "COMB_VEC": comb_vec[keep],
+            "NORM_VEC_DIFF": norm_diff[keep],
+            "NORM_COMB_VEC": norm_comb[keep],
+            "WEIGHTED": weighted[keep],
+            "RES": trials["RES"][keep] / 10,
+            "SITES": trials["SITES"][keep],
+        },
+        columns=columns,
+    )
+
+
+def make_symmetry(unitcell, spacegroup):
+    return crystal.symmetry(
+        unit_cell=tuple(float(x) for x in unitcell.split()),
+        space_group_symbol=spacegroup,
+    )
+
+
+def emma_match(pdb1, pdb2, symmetry, tolerance=3.0):
+    # what phenix.emma does, in process: the best match of the two site sets
+    # over the allowed origin shifts and hands. Returns (matched pairs, sites
+    # in each model, rms of the match)
+    models = [
+        iotbx.pdb.input(file_name=f)
+        .xray_structure_simple(crystal_symmetry=symmetry)
+        .as_emma_model()
+        for f in (pdb1, pdb2)
+    ]
+    matches = emma.model_matches(
+        models[0],
+        models[1],
+        tolerance=tolerance,
+        models_are_diffraction_index_equivalent=False,
+    )
+    sizes = [len(model.positions()) for model in models]
+    if not matches.refined_matches:
+        return 0, sizes[0], sizes[1], None
+    best = matches.refined_matches[0]
+    return len(best.pairs), sizes[0], sizes[1], best.rms
+
+
+def emma_compare(pdb1, pdb2, unitcell, spacegroup, tolerance=3.0):
+    # pool worker, plain arguments in and out
+    try:
+        return emma_match(pdb1, pdb2, make_symmetry(unitcell, spacegroup), tolerance)
+    except Exception as e:
+        print(f"Could not compare {pdb1} and {pdb2}: {e}")
+        return None
+
+
+def emma_text(match):
+    # the phenix.emma summary lines emma_correlation_plot reads
+    if match is None:
+        return ""
+    pairs, n1, n2, rms = match
+    return (
+        f"Pairs: {pairs}\n"
+        f"Singles model 1: {n1 - pairs}\n"
+        f"Singles model 2: {n2 - pairs}\n"
+    )
+
+
+def plot_cells(trials_file, bounds, filenames, dpi=100):
+    # CCall against CCweak for a batch of cells on one Agg canvas, only the
+    # points and limits change between cells. Each worker maps the store
+    # itself and reads its cells (start/end rows in bounds) from it. No pyplot
+    # state is involved so it is safe in pool workers
+    trials = np.load(trials_file, mmap_mode="r")
+    fig = Figure(figsize=(6.4, 4.8))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.set_xlabel("CCweak")
+    ax.set_ylabel("CCall")
+    points = ax.scatter([], [], marker="o", s=8)
+    for (a, b), filename in zip(bounds, filenames):
+        if a == b:
+            continue
+        cell = trials[a:b]
+        x, y = np.asarray(cell["CCWEAK"]), np.asarray(cell["CCALL"])
+        points.set_offsets(np.column_stack((x, y)))
+        padx, pady = max(np.ptp(x), 1) * 0.05, max(np.ptp(y), 1) * 0.05
+        ax.set_xlim(x.min() - padx, x.max() + padx)
+        ax.set_ylim(y.min() - pady, y.max() + pady)
+        fig.savefig(filename, dpi=dpi)
+    return len(filenames)
+
+
+def plot_tiled(cells, filename, dpi=100):
+    # the whole grid as small multiples on shared axes, resolution across and
+    # sites down
+    res = sorted({i for cell, i, j in cells})
+    sites = sorted({j for cell, i, j in cells}, reverse=True)
+    fig = Figure(figsize=(1.2 * len(res) + 1, 1.2 * len(sites) + 1))
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(len(sites), len(res), squeeze=False, sharex=True, sharey=True)
+    for ax in axes.flat:
+        ax.tick_params(labelsize=5)
+    for cell, i, j in cells:
+        ax = axes[sites.index(j), res.index(i)]
+        ax.scatter(cell["CCWEAK"], cell["CCALL"], s=0.5, rasterized=True)
+    for col, i in enumerate(res):
+        axes[0, col].set_title(str(i / 10), fontsize=6)
+    for row, j in enumerate(sites):
+        axes[row, 0].set_ylabel(str(j), fontsize=6)
+    fig.supxlabel("CCweak by resolution (A)")
+    fig.supylabel("CCall by number of sites")
+    fig.savefig(filename, dpi=dpi)
+
 
 class core:
     def __init__(self):
         self.timestamp = datetime.now()
         self.path = os.getcwd()
+        # early stopping is off unless a MAD multiplier is given
+        self.stop_confidence = None
+        self.stop_min_trials = 200
+        self.tails = {}
+        # set while an adaptive coarse pass waits to be refined
+        self.coarse = False
+        # the input data, hashed and read once when first needed
+        self.data_hash = None
+        self.data_file = None
+        self.poll_interval = 60
+        # local runs: threads per SHELXD and how many run at once (None fills
+        # the machine)
+        self.local_threads = 4
+        self.local_jobs = None
+        self.backend = None
+        self.cache = prep_cache()
+        # figures: dpi, and "lazy" for none beyond the explorer page (drawn in
+        # the browser when a cell is opened), "cells" for a PNG per cell,
+        # "tiled" for one image of the whole grid or "both"
+        self.plot_dpi = 100
+        self.plot_mode = "lazy"
 
     def get_input(self):
         self.projname = input("Name of project: ")
@@ -44,11 +707,20 @@ class core:
         self.midsites = int(((self.highsites - self.lowsites) / 2) + self.lowsites)
         self.ntry = int(input("Number of trials: "))
         self.atomin = input("Anomalous scatterer: ")
-        self.clust = str(input("Run on (c)luster or (l)ocal machine? c/l ")).lower()
+        self.clust = str(
+            input(
+                "Run on (c)luster, (s)lurm, slurm (r)est or (l)ocal machine? c/s/r/l "
+            )
+        ).lower()
+        self.adaptive = str(
+            input("Coarse pass first and refine around the best cells? y/n ")
+        ).lower()
+        stop = input("Stop once a cell is this many MADs out (blank to run all): ")
+        self.stop_confidence = float(stop) if stop.strip() else None
         self.clusteranalysis = "y"
         self.insin = os.path.join(self.fa_path, self.projname + "_fa.ins")
         self.hklin = os.path.join(self.fa_path, self.projname + "_fa.hkl")
-        self.writepickle()
+        self.writeconfig()
         return (
             self.projname,
             self.fa_path,
@@ -59,167 +731,321 @@ class core:
             self.ntry,
         )
 
-    def drmaa2template_emma(self, emma1, emma2):
-        emma_jt = JobTemplate(
-            {
-                "job_name": "emma",
-                "job_category": "i23_chris",
-                "remote_command": "/dls/science/groups/i23/scripts/chris/Sagasu/emma.sh",
-                "args": [f"--symmetry={str(self.path)}/aimless.mtz", {str(emma1)}, {str(emma2)}],
-                "min_slots": 1,
-                "max_slots": 1,
-                "working_directory": str(self.path),
-                "output_path": str(self.path),
-                "error_path": str(self.path),
-                "queue_name": "low.q",
-                "implementation_specific": {
-                    "uge_jt_pe": "smp",
-                },
-            }
-        )
-        return emma_jt
+    def template_emma(self, emma1, emma2):
+        return {
+            "job_name": "emma",
+            "remote_command": "/dls/science/groups/i23/scripts/chris/Sagasu/emma.sh",
+            "args": [
+                f"--symmetry={str(self.path)}/aimless.mtz",
+                str(emma1),
+                str(emma2),
+            ],
+            "min_slots": 1,
+            "max_slots": 1,
+            "working_directory": str(self.path),
+        }
 
     def run_emma_cluster(self, parallel_filelist):
-        self.session = JobSession()
-        self.job_details = []
-        for emma1, emma2 in parallel_filelist:
-            template = self.drmaa2template_emma(emma1, emma2)
-            job = self.session.run_job(template)
-            self.job_details.append([job])
-
-    def drmaa2template_shelxd(self, workpath):
-        shelxd_jt = JobTemplate(
-            {
+        specs = [self.template_emma(emma1, emma2) for emma1, emma2 in parallel_filelist]
+        jobs = self.submit_array(specs)
+        self.job_details = [[job, "emma_" + str(n)] for n, job in enumerate(jobs)]
+
+    def template_shelxd(self, workpath):
+        if self.clust == "l":
+            # straight to shelxd, the local pool shares the cores out
+            return {
                 "job_name": "sagasu",
-                "job_category": "i23_chris",
-                "remote_command": "/dls/science/groups/i23/scripts/chris/Sagasu/shelxd.sh",
-                "args": [str(self.projname + "_fa")],
-                "min_slots": 20,
-                "max_slots": 40,
+                "remote_command": "shelxd",
+                "args": [str(self.projname + "_fa"), "-L" + str(self.local_threads)],
+                "min_slots": self.local_threads,
+                "max_slots": self.local_threads,
                 "working_directory": str(workpath),
-                "output_path": str(workpath),
-                "error_path": str(workpath),
-                "queue_name": "low.q",
-                "implementation_specific": {
-                    "uge_jt_pe": "smp",
-                },
             }
-        )
-        return shelxd_jt
-
-    def drmaa2template_afroprasa(self, workpath, rescut):
+        return {
+            "job_name": "sagasu",
+            "remote_command": "/dls/science/groups/i23/scripts/chris/Sagasu/shelxd.sh",
+            "args": [str(self.projname + "_fa")],
+            "min_slots": 20,
+            "max_slots": 40,
+            "working_directory": str(workpath),
+        }
+
+    def template_afroprasa(self, workpath, rescut):
         hr = str(self.highres / 10)
         lr = str(self.lowres / 10)
         rs = str(int(rescut) / 10)
-        afroprasa_jt = JobTemplate(
-            {
-                "job_name": "afro_prasa",
-                "job_category": "i23_chris",
-                "remote_command": "/dls/science/groups/i23/scripts/chris/Sagasu/afroprasa.sh",
-                "args": [
-                    f"{str(self.atomin)}",  # $1
-                    f"{str(self.midsites)}",  # $2
-                    f"{str(rs)}",  # $3
-                    f"{str(self.ntry)}",  # $4
-                    f"{lr}",  # $5
-                    f"{hr}",  # $6
-                    f"{str(self.highsites)}",  # $7
-                    f"{str(self.lowsites)}",  # $8
-                ],
-                "min_slots": 20,
-                "max_slots": 40,
-                "working_directory": str(workpath),
-                "output_path": str(workpath),
-                "error_path": str(workpath),
-                "queue_name": "low.q",
-                "implementation_specific": {
-                    "uge_jt_pe": "smp",
-                },
-            }
+        return {
+            "job_name": "afro_prasa",
+            "remote_command": "/dls/science/groups/i23/scripts/chris/Sagasu/afroprasa.sh",
+            "args": [
+                f"{str(self.atomin)}",  # $1
+                f"{str(self.midsites)}",  # $2
+                f"{str(rs)}",  # $3
+                f"{str(self.ntry)}",  # $4
+                f"{lr}",  # $5
+                f"{hr}",  # $6
+                f"{str(self.highsites)}",  # $7
+                f"{str(self.lowsites)}",  # $8
+            ],
+            "min_slots": 20,
+            "max_slots": 40,
+            "working_directory": str(workpath),
+        }
+
+    def submit_array(self, specs):
+        # the same job in many directories goes to the scheduler as one array,
+        # task n runs line n of the manifest. Each array gets a manifest of its
+        # own, one still queued keeps reading the lines it was submitted with
+        name = specs[0]["job_name"]
+        handle, manifest = tempfile.mkstemp(
+            prefix=name + "_tasks_",
+            suffix=".txt",
+            dir=os.path.join(self.path, self.projname),
+        )
+        with os.fdopen(handle, "w") as tasks:
+            for spec in specs:
+                tasks.write(
+                    shlex.quote(str(spec["working_directory"]))
+                    + " "
+                    + sagasu_backends.command_line(spec)
+                    + "\n"
+                )
+        array_spec = dict(
+            specs[0],
+            remote_command="/dls/science/groups/i23/scripts/chris/Sagasu/array_task.sh",
+            args=[manifest],
+            working_directory=os.path.join(self.path, self.projname),
         )
-        return afroprasa_jt
-
-    def drmaa2_check(self):
-        job_list = [job_info[0] for job_info in self.job_details]
-        time.sleep(10)
-        self.session.wait_all_started(job_list)
-        time.sleep(10)
-        self.session.wait_all_terminated(job_list)
-
-    def writepickle(self):
-        with open("inps.pkl", "wb") as f:
-            pickle.dump(
-                [
-                    self.projname,
-                    self.lowres,
-                    self.highres,
-                    self.lowsites,
-                    self.highsites,
-                    self.ntry,
-                    self.clusteranalysis,
-                    self.clust,
-                    self.insin,
-                    self.hklin,
-                    self.atomin,
-                    self.prasa_datain,
-                    self.midsites,
-                    self.unitcell,
-                    self.spacegroup,
-                ],
-                f,
+        return self.get_backend().submit_array(array_spec, len(specs))
+
+    def get_backend(self):
+        if self.backend is None:
+            threads = max(1, min(self.local_threads, os.cpu_count()))
+            jobs = self.local_jobs or max(1, os.cpu_count() // threads)
+            self.backend = sagasu_backends.make_backend(self.clust, jobs)
+            if self.clust == "l":
+                print(f"Running {jobs} SHELXD jobs at a time with {threads} threads")
+        return self.backend
+
+    def check_jobs(self, on_done=None):
+        # polls the backend until every job has finished, reporting each job
+        # as it changes state. on_done(label) is called for every job that
+        # finishes cleanly so its results can be picked up straight away.
+        # Once a cell becomes convincing the other SHELXD cells are cancelled,
+        # that cell and PRASA run to the end.
+        start = time.time()
+        stopped = sagasu_backends.FINISHED + ("cancelled",)
+        self.job_status = {
+            label: {"state": "queued", "started": None, "finished": None}
+            for job, label in self.job_details
+        }
+        cancelled = False
+        while True:
+            for job, label in self.job_details:
+                status = self.job_status[label]
+                if status["state"] in stopped:
+                    continue
+                state = self.get_backend().poll(job)
+                if state == status["state"]:
+                    continue
+                now = time.time() - start
+                if state != "queued" and status["started"] is None:
+                    status["started"] = now
+                    print(f"{label} running after {now:.0f} s in the queue")
+                if state in sagasu_backends.FINISHED:
+                    status["finished"] = now
+                    status["exit"] = self.get_backend().exit_status(job)
+                    print(
+                        f"{label} {state} after {now - status['started']:.0f} s "
+                        f"(exit {status['exit']})"
+                    )
+                    if state == "done" and on_done is not None:
+                        on_done(label)
+                status["state"] = state
+            states = [status["state"] for status in self.job_status.values()]
+            if all(state in stopped for state in states):
+                break
+            print(
+                ", ".join(
+                    f"{states.count(state)} {state}"
+                    for state in sagasu_backends.JOB_STATES + ("cancelled",)
+                    if state in states
+                )
+                + f" after {time.time() - start:.0f} s"
             )
+            if not cancelled and self.stop_confidence is not None:
+                hit = self.early_stop_check()
+                if hit:
+                    self.cancel_jobs(keep=[str(hit[0]) + "_" + str(hit[1])])
+                    cancelled = True
+            time.sleep(self.poll_interval)
+        failed = [
+            label
+            for label, status in self.job_status.items()
+            if status["state"] == "failed"
+        ]
+        if failed:
+            print(f"{len(failed)} of {len(states)} jobs failed: " + ", ".join(failed))
+        pd.DataFrame.from_dict(self.job_status, orient="index").to_csv(
+            os.path.join(self.path, self.projname, "jobs.csv"), index_label="job"
+        )
+        manifest = self.load_manifest()
+        for label, status in self.job_status.items():
+            if label in manifest["cells"]:
+                manifest["cells"][label]["state"] = status["state"]
+        self.save_manifest(manifest)
+
+    def parse_when_done(self, pool):
+        # on_done callback for check_jobs, each SHELXD cell is parsed on the
+        # pool as soon as its job finishes
+        self.parsing = {}
+
+        def on_done(label):
+            i, _, j = label.partition("_")
+            # SHELXD cells only, not <res>_prasa or emma_<n>
+            if i.isdigit() and j.isdigit():
+                i, j = int(i), int(j)
+                self.parsing[(i, j)] = pool.apply_async(
+                    parse_cell, (self.lstfile(i, j), i, j)
+                )
 
-    def readpickle(self):
-        with open("inps.pkl", "rb") as f:
-            (
-                self.projname,
-                self.lowres,
-                self.highres,
-                self.lowsites,
-                self.highsites,
-                self.ntry,
-                self.clusteranalysis,
-                self.clust,
-                self.insin,
-                self.hklin,
-                self.atomin,
-                self.prasa_datain,
-                self.midsites,
-                self.unitcell,
-                self.spacegroup,
-            ) = pickle.load(f)
-
-    def replace(self, file, pattern, subst):
-        file_handle = open(file, "r")
-        file_string = file_handle.read()
-        file_handle.close()
-        file_string = re.sub(pattern, subst, file_string)
-        file_handle = open(file, "w")
-        file_handle.write(file_string)
-        file_handle.close()
+        return on_done
+
+    def early_stop_check(self):
+        # res/sites of the cell with most trials beyond stop_confidence * MAD
+        # in both CCall and CCweak, None while nothing is convincing yet
+        parsed = [
+            np.array([(i, j) + row for row in tail.read()], dtype=TRIALS_DTYPE)
+            for (i, j), tail in self.tails.items()
+        ]
+        parsed = [cell for cell in parsed if len(cell) >= self.stop_min_trials]
+        if not parsed:
+            return None
+        ccall, ccweak = mad_outliers(
+            np.concatenate(parsed), multipliers=(self.stop_confidence,)
+        )
+        column = "mad" + str(self.stop_confidence)
+        counts = ccall[column] + ccweak[column]
+        convincing = (ccall[column] > 0) & (ccweak[column] > 0)
+        if not convincing.any():
+            return None
+        best = counts[convincing].idxmax()
+        hit = (int(round(ccall["res"][best] * 10)), int(ccall["sites"][best]))
+        print(f"Convincing solution at {hit[0] / 10} Å with {hit[1]} sites")
+        return hit
+
+    def cancel_jobs(self, keep=()):
+        # every unfinished SHELXD cell but those in keep, PRASA is left alone.
+        # They are recorded as cancelled, not failed, and resubmitted by the
+        # next run
+        print("Cancelling the remaining SHELXD jobs")
+        for job, label in self.job_details:
+            status = self.job_status[label]
+            i, _, j = label.partition("_")
+            if not (i.isdigit() and j.isdigit()) or label in keep:
+                continue
+            if status["state"] in sagasu_backends.FINISHED:
+                continue
+            self.get_backend().cancel(job)
+            status["state"] = "cancelled"
+
+    def config(self):
+        return validate_config({name: getattr(self, name) for name in CONFIG_FIELDS})
+
+    def config_file(self):
+        return os.path.join(self.path, CONFIG_FILE)
+
+    def writeconfig(self):
+        with open(self.config_file() + ".tmp", "w") as f:
+            json.dump(self.config(), f, indent=1)
+        os.replace(self.config_file() + ".tmp", self.config_file())
+
+    def has_config(self):
+        return os.path.exists(self.config_file()) or os.path.exists(
+            os.path.join(self.path, "inps.pkl")
+        )
+
+    def readconfig(self):
+        # runs from before sagasu.json are read from inps.pkl and converted
+        if os.path.exists(self.config_file()):
+            with open(self.config_file()) as f:
+                config = validate_config(json.load(f))
+        else:
+            with open(os.path.join(self.path, "inps.pkl"), "rb") as f:
+                config = validate_config(dict(zip(LEGACY_FIELDS, pickle.load(f))))
+        self.setconfig(config)
+        if not os.path.exists(self.config_file()):
+            self.writeconfig()
+        return config
+
+    def setconfig(self, config):
+        config = validate_config(config)
+        for name in CONFIG_FIELDS:
+            setattr(self, name, config[name])
+        return config
+
+    def config_from_args(self, args):
+        # the get_input answers given as command line flags
+        self.projname = args.proj
+        self.prasa_datain = args.data
+        self.unitcell, self.spacegroup = args.cell, args.sg
+        if not (self.unitcell and self.spacegroup):
+            # the data only fills in whichever of the two was not given
+            self.get_unit_cell_and_sg(False, args.cell, args.sg)
+        self.fa_path = self.path
+        config = dict(
+            projname=args.proj,
+            prasa_datain=args.data,
+            fa_path=self.path,
+            insin=os.path.join(self.path, args.proj + "_fa.ins"),
+            hklin=os.path.join(self.path, args.proj + "_fa.hkl"),
+            atomin=args.atom,
+            unitcell=self.unitcell,
+            spacegroup=self.spacegroup,
+            highres=int(10 * args.highres),
+            lowres=int(10 * args.lowres),
+            highsites=args.maxsites,
+            lowsites=args.minsites,
+            midsites=int(((args.maxsites - args.minsites) / 2) + args.minsites),
+            ntry=args.ntry,
+            clust=args.backend,
+            clusteranalysis="y",
+            adaptive="y" if args.adaptive else "n",
+            stop_confidence=args.stop,
+        )
+        self.setconfig(config)
+        self.writeconfig()
+        return config
+
+    def __getstate__(self):
+        # bound methods handed to a pool only carry the run config, not the
+        # backend, job handles or anything parsed so far
+        return {
+            name: value
+            for name, value in self.__dict__.items()
+            if name in CONFIG_FIELDS or name == "path"
+        }
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.__dict__.update(state)
 
     def shelxd_prep(self):
-        print("Running SHEXC...")
-        os.system("module load ccp4")
-        print("Loaded shelx")
-        print(
-            f"""
-shelxc {self.projname} > /dev/null 2>&1 <<EOF
-SAD aimless.sca
-SFAC {(self.atomin).upper()}
-CELL {self.unitcell}
-SPAG {self.spacegroup}
-SHEL 999 {str(self.highres)}
-FIND {str(self.lowsites)}
-MIND -1.5
-FRES 5
-EOF
-                  """
+        key = self.cache.key(
+            "shelxc",
+            self.data_key(),
+            self.atomin.upper(),
+            self.unitcell,
+            self.spacegroup,
+            self.highres,
+            self.lowsites,
         )
-        os.system(
-            f"""
-shelxc {self.projname} > /dev/null 2>&1 <<EOF
-SAD aimless.sca
+        products = {"fa.ins": self.insin, "fa.hkl": self.hklin}
+        if self.cache.fetch(key, products):
+            print("SHELXC output taken from the prep cache")
+            return
+        print("Running SHEXC...")
+        shelxc_input = f"""SAD aimless.sca
 SFAC {(self.atomin).upper()}
 CELL {self.unitcell}
 SPAG {self.spacegroup}
@@ -227,152 +1053,359 @@ SHEL 999 {str(self.highres)}
 FIND {str(self.lowsites)}
 MIND -1.5
 FRES 5
-EOF
-                  """
-        )
+"""
+        print(shelxc_input)
+        run_tool(["shelxc", self.projname], stdin=shelxc_input)
+        for f in (self.insin, self.hklin):
+            if not os.path.exists(f):
+                raise RuntimeError(f"shelxc did not write {f}")
+        self.cache.store(key, products)
+
+    def data_key(self):
+        # input file contents and the symmetry it is merged in
+        if self.data_hash is None:
+            self.data_hash = file_hash(self.prasa_datain)
+        return self.cache.key("data", self.data_hash, self.unitcell, self.spacegroup)
+
+    def read_data(self):
+        # the input file is only read once per run
+        if self.data_file is None:
+            self.data_file = any_file(self.prasa_datain)
+        return self.data_file
+
+    def symmetry(self):
+        return make_symmetry(self.unitcell, self.spacegroup)
 
     # this preps for prasa and shelxd
     def prasa_prep(self):
-        os.system("module load ccp4")
-        if self.prasa_datain.endswith(".hkl" or ".HKL"):
-            self.pointless = (
-                "pointless HKLOUT pointless.mtz HKLIN "
-                + str(self.prasa_datain)
-                + " > /dev/null 2>&1"
-            )
-        elif self.prasa_datain.endswith(".sca" or ".SCA"):
-            self.pointless = "pointless HKLOUT pointless.mtz SCAIN " + str(
-                self.prasa_datain + " > /dev/null 2>&1"
-            )
+        start = time.perf_counter()
+        products = {
+            name: os.path.join(self.path, name)
+            for name in ("aimless.sca", "aimless.mtz", "truncate.mtz")
+        }
+        if self.cache.fetch(self.data_key(), products):
+            print("Merged data taken from the prep cache")
+            return
+        try:
+            i_obs = pick_intensities(self.read_data().file_server.miller_arrays)
+        except Exception as e:
+            print(f"iotbx could not read {self.prasa_datain}: {e}")
+            i_obs = None
+        if i_obs is None:
+            self.ccp4_prep()
         else:
-            print("\nMust be an mtz file in...\n")
-            self.pointless = (
-                f"pointless HKLOUT pointless.mtz HKLIN "
-                + str(self.prasa_datain)
-                + " > /dev/null 2>&1"
-            )
-        os.system(str(self.pointless))
-        os.system(
-            """
-aimless HKLIN pointless.mtz HKLOUT aimless.mtz > /dev/null 2>&1 << eof
-ANOMALOUS ON
-eof
-        """
+            self.merged = merge_anomalous(i_obs, self.symmetry())
+            write_prep_outputs(self.merged, self.path)
+        self.cache.store(self.data_key(), products)
+        print(f"Data prepared in {time.perf_counter() - start:.1f} s")
+
+    def ccp4_prep(self):
+        # for input iotbx has no intensities for, the old pointless, aimless,
+        # mtz2sca and ctruncate chain
+        print("Scaling with pointless/aimless")
+        kind = "SCAIN" if self.prasa_datain.lower().endswith(".sca") else "HKLIN"
+        run_tool(["pointless", "HKLOUT", "pointless.mtz", kind, self.prasa_datain])
+        run_tool(
+            ["aimless", "HKLIN", "pointless.mtz", "HKLOUT", "aimless.mtz"],
+            stdin="ANOMALOUS ON\n",
         )
-        os.system("mtz2sca aimless.mtz > /dev/null 2>&1")
-        os.system(
-            "ctruncate -hklin aimless.mtz -hklout truncate.mtz -colin '/*/*/[I(+),SIGI(+),I(-),SIGI(-)]' > /dev/null 2>&1"
+        run_tool(["mtz2sca", "aimless.mtz"])
+        run_tool(
+            [
+                "ctruncate",
+                "-hklin",
+                "aimless.mtz",
+                "-hklout",
+                "truncate.mtz",
+                "-colin",
+                "/*/*/[I(+),SIGI(+),I(-),SIGI(-)]",
+            ]
         )
 
-    def get_unit_cell_and_sg(self):
+    def get_unit_cell_and_sg(self, interactive=True, unitcell=None, spacegroup=None):
+        # a cell or space group given is kept, only the other is looked up
+        self.unitcell, self.spacegroup = unitcell, spacegroup
         try:
-            read_data_file = any_file(self.prasa_datain)
+            read_data_file = self.read_data()
             data_file_symm = read_data_file.crystal_symmetry()
             symm_as_py_code = data_file_symm.as_py_code()
-            unit_cell_match = re.search(r"unit_cell=\((.*?)\)", symm_as_py_code)
-            self.unitcell = unit_cell_match.group(1)
-            self.unitcell = self.unitcell.replace(",", "")
-            space_group_match = re.search(
-                r'space_group_symbol="([^"]+)"', symm_as_py_code
-            )
-            self.spacegroup = space_group_match.group(1)
-            self.spacegroup = self.spacegroup.replace(" ", "")
+            if not self.unitcell:
+                unit_cell_match = re.search(r"unit_cell=\((.*?)\)", symm_as_py_code)
+                self.unitcell = unit_cell_match.group(1)
+                self.unitcell = self.unitcell.replace(",", "")
+            if not self.spacegroup:
+                space_group_match = re.search(
+                    r'space_group_symbol="([^"]+)"', symm_as_py_code
+                )
+                self.spacegroup = space_group_match.group(1)
+                self.spacegroup = self.spacegroup.replace(" ", "")
         except:
             pass
         if self.unitcell and self.spacegroup:
             print(
                 f"Spacegroup and unit cell identified as {str(self.spacegroup)}, {str(self.unitcell)}"
             )
-        else:
-            self.spacegroup = input(
-                "Could not determine spacegroup, enter now (eg. P321): "
-            )
-            self.unitcell = input(
-                "Could not determine unit cell, enter now (eg. 150 150 45 90 90 120): "
+        elif not interactive:
+            raise ValueError(
+                f"Could not determine the cell of {self.prasa_datain}, give --cell and --sg"
             )
-
-    def run_sagasu_proc(self):
-        self.session = JobSession()
-        os.chdir(self.path)
-        self.job_details = []
-        Path(self.projname).mkdir(parents=True, exist_ok=True)
-        i = self.highres
-        if self.clust == "l":
-            tot = (self.lowres - self.highres) * ((self.highsites + 1) - self.lowsites)
         else:
-            pass
-        while not (i >= self.lowres):
-            Path(os.path.join(self.projname, str(i))).mkdir(parents=True, exist_ok=True)
-            i2 = i / 10
-            j = self.highsites
-            while not (j <= (self.lowsites - 1)):
-                os.makedirs(os.path.join(self.projname, str(i), str(j)), exist_ok=True)
-                shutil.copy2(self.insin, (os.path.join(self.projname, str(i), str(j))))
-                shutil.copy2(self.hklin, (os.path.join(self.projname, str(i), str(j))))
-                workpath = os.path.join(self.path, self.projname, str(i), str(j))
-                f = os.path.join(
-                    self.path, self.projname, str(i), str(j), self.projname + "_fa.ins"
+            if not self.spacegroup:
+                self.spacegroup = input(
+                    "Could not determine spacegroup, enter now (eg. P321): "
                 )
-                self.replace(f, "FIND", "FIND " + str(j) + "\n")
-                self.replace(f, "SHEL", "SHEL 999 " + str(i2) + "\n")
-                self.replace(f, "NTRY", "NTRY " + str(self.ntry) + "\n")
-                if self.clust == "l":
-                    os.chdir(workpath)
-                    subprocess.run(
-                        ["shelxd", self.projname + "_fa"], stdout=subprocess.PIPE
-                    )
-                    os.chdir(self.path)
-                elif self.clust == "c":
-                    template = self.drmaa2template_shelxd(workpath)
-                    job = self.session.run_job(template)
-                    self.job_details.append([job])
-                else:
-                    print("error in input...")
-                j = j - 1
-            if self.clust == "c":
-                os.makedirs(
-                    os.path.join(self.projname, str(i), str(i) + "_prasa"),
-                    exist_ok=True,
+            if not self.unitcell:
+                self.unitcell = input(
+                    "Could not determine unit cell, enter now (eg. 150 150 45 90 90 120): "
                 )
+
+    def grid_cells(self):
+        # every res/sites cell, walked from high res and most sites down
+        return [
+            (i, j)
+            for i in range(self.highres, self.lowres)
+            for j in range(self.highsites, self.lowsites - 1, -1)
+        ]
+
+    def cellpath(self, i, j):
+        return os.path.join(self.path, self.projname, str(i), str(j))
+
+    def clear_outputs(self, i, j):
+        for ext in ("_fa.lst", "_fa.res", "_fa.pdb"):
+            path = os.path.join(self.cellpath(i, j), self.projname + ext)
+            if os.path.lexists(path):
+                os.remove(path)
+
+    def lstfile(self, i, j):
+        return os.path.join(
+            self.path, self.projname, str(i), str(j), str(self.projname) + "_fa.lst"
+        )
+
+    def run_sagasu_proc(self, cells=None, ntry=None, prasa=True):
+        os.chdir(self.path)
+        self.job_details = []
+        if cells is None:
+            cells = self.grid_cells()
+        if ntry is None:
+            ntry = self.ntry
+        # cells that already ran to completion with the same inputs are kept.
+        # The inputs are what the cell itself reads, its rendered .ins (NTRY
+        # aside, more trials are compared separately) and its resolution
+        # shell, so extending the grid leaves the existing cells alone
+        manifest = self.load_manifest()
+        with open(self.insin) as f:
+            template = f.readlines()
+        hkl_hashes = hkl_shell_hashes(
+            self.hklin, self.unitcell, set(i / 10 for i, j in cells)
+        )
+        inputs = {
+            (i, j): {
+                "ins": hashlib.sha256(
+                    render_ins(
+                        template,
+                        {
+                            "FIND": "FIND " + str(j),
+                            "SHEL": "SHEL 999 " + str(i / 10),
+                            "NTRY": "NTRY",
+                        },
+                    ).encode()
+                ).hexdigest(),
+                "hkl": hkl_hashes[i / 10],
+            }
+            for i, j in cells
+        }
+        current = [
+            (i, j)
+            for i, j in cells
+            if self.up_to_date(
+                manifest, str(i) + "_" + str(j), inputs[i, j], ntry, self.lstfile(i, j)
+            )
+            and os.path.exists(self.lstfile(i, j))
+        ]
+        if current:
+            print(f"{len(current)} of {len(cells)} cells are up to date, skipping")
+        cells = [cell for cell in cells if cell not in current]
+        for i, j in cells:
+            manifest["cells"][str(i) + "_" + str(j)] = dict(
+                inputs[i, j], res=i, sites=j, ntry=ntry, state="submitted"
+            )
+            # nothing of an earlier run may be tailed or parsed as this one
+            self.clear_outputs(i, j)
+        self.tails = {(i, j): lst_tail(self.lstfile(i, j)) for i, j in cells}
+        start = time.perf_counter()
+        written = 0
+        # every directory up front, then per cell only the rendered .ins is
+        # written and the .hkl is linked to the one cut for its resolution
+        for i, j in sorted(cells):
+            os.makedirs(self.cellpath(i, j), exist_ok=True)
+        # one pre-cut .hkl per resolution, shared by that row of cells
+        shells = {
+            i: os.path.join(self.path, self.projname, str(i), self.projname + "_fa.hkl")
+            for i in set(i for i, j in cells)
+        }
+        written += write_hkl_shells(
+            self.hklin, self.unitcell, {i / 10: f for i, f in shells.items()}
+        )
+        shelxd_jobs = []
+        for i, j in cells:
+            workpath = self.cellpath(i, j)
+            ins = render_ins(
+                template,
+                {
+                    "FIND": "FIND " + str(j),
+                    "SHEL": "SHEL 999 " + str(i / 10),
+                    "NTRY": "NTRY " + str(ntry),
+                },
+            )
+            with open(os.path.join(workpath, self.projname + "_fa.ins"), "w") as f:
+                f.write(ins)
+            written += len(ins)
+            written += link_into(
+                shells[i], os.path.join(workpath, self.projname + "_fa.hkl")
+            )
+            shelxd_jobs.append((str(i) + "_" + str(j), self.template_shelxd(workpath)))
+        prasa_jobs = []
+        if self.clust != "l" and prasa:
+            truncate = file_hash("truncate.mtz")
+            for i in sorted(set(i for i, j in cells)):
+                label = str(i) + "_prasa"
                 workpath = os.path.join(
                     self.path, self.projname, str(i), str(i) + "_prasa"
                 )
-                shutil.copy2(
-                    "truncate.mtz",
-                    (os.path.join(self.projname, str(i), str(i) + "_prasa")),
+                # PRASA reads truncate.mtz and is driven by its arguments
+                prasa_inputs = {
+                    "ins": hashlib.sha256(
+                        json.dumps(
+                            self.template_afroprasa(workpath, str(i))["args"]
+                        ).encode()
+                    ).hexdigest(),
+                    "hkl": truncate,
+                }
+                if self.up_to_date(manifest, label, prasa_inputs, self.ntry):
+                    continue
+                manifest["cells"][label] = dict(
+                    prasa_inputs, res=i, ntry=self.ntry, state="submitted"
                 )
-                prasa_template = self.drmaa2template_afroprasa(workpath, str(i))
-                job = self.session.run_job(prasa_template)
-                self.job_details.append([job])
-            else:
-                pass
-            i = i + 1
+                os.makedirs(workpath, exist_ok=True)
+                written += link_into(
+                    "truncate.mtz", os.path.join(workpath, "truncate.mtz")
+                )
+                prasa_jobs.append(
+                    (str(i) + "_prasa", self.template_afroprasa(workpath, str(i)))
+                )
+        print(
+            f"Set up {len(cells)} cells in {time.perf_counter() - start:.2f} s, "
+            f"{written / 1e6:.1f} MB written"
+        )
+        if self.clust == "l":
+            for label, spec in shelxd_jobs:
+                self.job_details.append([self.get_backend().submit(spec), label])
+        else:
+            for labelled in (shelxd_jobs, prasa_jobs):
+                if labelled:
+                    labels, specs = zip(*labelled)
+                    jobs = self.submit_array(list(specs))
+                    self.job_details += [list(pair) for pair in zip(jobs, labels)]
+        self.save_manifest(manifest)
+
+    def manifest_file(self):
+        return os.path.join(self.path, self.projname, "sagasu_manifest.json")
+
+    def load_manifest(self):
+        # per cell: the inputs it was run with (.ins/.hkl hashes, res, sites,
+        # NTRY), how its job ended, and the .lst fingerprint at the last parse
+        if os.path.exists(self.manifest_file()):
+            with open(self.manifest_file()) as f:
+                manifest = json.load(f)
+            if manifest.get("version") == MANIFEST_VERSION:
+                return manifest
+        return {"version": MANIFEST_VERSION, "cells": {}}
+
+    def save_manifest(self, manifest):
+        Path(os.path.dirname(self.manifest_file())).mkdir(parents=True, exist_ok=True)
+        with open(self.manifest_file() + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(self.manifest_file() + ".tmp", self.manifest_file())
+
+    def up_to_date(self, manifest, label, inputs, ntry, lstfile=None):
+        # a cell still marked submitted (the monitor was stopped before its
+        # job ended) counts as done once its .lst shows the whole run
+        entry = manifest["cells"].get(label)
+        if (
+            entry is None
+            or entry.get("ins") != inputs["ins"]
+            or entry.get("hkl") != inputs["hkl"]
+            or entry.get("ntry", 0) < ntry
+        ):
+            return False
+        if (
+            entry.get("state") in ("submitted", "running")
+            and lstfile is not None
+            and lst_complete(lstfile, entry["ntry"])
+        ):
+            entry["state"] = "done"
+        return entry.get("state") == "done"
+
+    def run_sagasu_coarse(self, coarse_fraction=0.1):
+        # adaptive runs: a coarse pass over the whole grid with a fraction of
+        # the trials first. Nothing waits here, refine_adaptive takes over
+        # once check_jobs has seen the coarse pass through
+        coarse_ntry = max(100, int(self.ntry * coarse_fraction))
+        print(f"Coarse pass with {coarse_ntry} trials per cell")
+        self.run_sagasu_proc(ntry=coarse_ntry, prasa=False)
+        self.coarse = True
+
+    def refine_adaptive(self, keep=3, radius=1):
+        # the coarse pass scored like tophits, then full NTRY only around the
+        # best cells
+        self.coarse = False
+        parsed = [
+            parse_cell(self.lstfile(i, j), i, j)
+            for i, j in self.grid_cells()
+            if os.path.exists(self.lstfile(i, j))
+        ]
+        # every coarse job may have failed or been cancelled
+        parsed = [cell for cell in parsed if len(cell)]
+        best = pd.DataFrame()
+        if parsed:
+            ccall, ccweak = mad_outliers(np.concatenate(parsed))
+            ccall["score"] = mad_score(ccall) + mad_score(ccweak)
+            best = ccall[ccall["score"] > 0].nlargest(keep, "score")
+        if best.empty:
+            print("Nothing stands out in the coarse pass, refining the whole grid")
+            refine = self.grid_cells()
+        else:
+            centres = [
+                (int(round(r * 10)), int(s)) for r, s in zip(best.res, best.sites)
+            ]
+            refine = [
+                (i, j)
+                for i, j in self.grid_cells()
+                if any(
+                    abs(i - ci) <= radius and abs(j - cj) <= radius
+                    for ci, cj in centres
+                )
+            ]
+        print(
+            f"Refining {len(refine)} of {len(self.grid_cells())} cells "
+            f"with {self.ntry} trials"
+        )
+        self.run_sagasu_proc(cells=refine)
 
     def cleanup_prev(self):
-        resultspath = os.path.join(self.path, self.projname + "_results")
+        # results and figures are kept between runs, the manifest says which
+        # cells have changed since they were made
         self.torun = []
         self.prasaruns = []
-        if os.path.exists(resultspath):
-            shutil.rmtree(resultspath)
         if not os.path.exists(self.projname + "_results"):
             os.mkdir(self.path + "/" + self.projname + "_results")
-        figspath = os.path.join(self.path, self.projname + "_figures")
-        if os.path.exists(figspath):
-            shutil.rmtree(figspath)
         if not os.path.exists(self.projname + "_figures"):
             os.mkdir(self.path + "/" + self.projname + "_figures")
         i = self.highres
         while not (i >= self.lowres):
             j = self.highsites
             while not (j <= (self.lowsites - 1)):
-                lstfile = os.path.join(
-                    self.path,
-                    self.projname,
-                    str(i),
-                    str(j),
-                    str(self.projname) + "_fa.lst",
-                )
-                self.torun.append((lstfile, i, j))
+                self.torun.append((self.lstfile(i, j), i, j))
                 j = j - 1
             prasaout = os.path.join(
                 self.path, self.projname, str(i), str(i) + "_prasa", "prasa.txt"
@@ -383,427 +1416,207 @@ eof
         prasaruns = self.prasaruns
         return torun, prasaruns
 
-    def results(self, filename, i, j):
-        with open(filename, "r") as file:
-            filedata = file.read()
-            filedata = filedata.replace("/", " ")
-            filedata = filedata.replace(",", " ")
-            filedata = filedata.replace("CC", "")
-            filedata = filedata.replace("All", "")
-            filedata = filedata.replace("Weak", "")
-            filedata = filedata.replace("CFOM", "")
-            filedata = filedata.replace("best", "")
-            filedata = filedata.replace("PATFOM", "")
-            filedata = filedata.replace("CPU", "")
-        with open(filename, "w") as file:
-            file.write(filedata)
-        with open(filename, "r") as infile, open(
-            self.path
-            + "/"
-            + self.projname
-            + "_results/"
-            + str(i)
-            + "_"
-            + str(j)
-            + ".csv",
-            "w",
-        ) as outfile:
-            for line in infile:
-                if line.startswith(" Try"):
-                    line.replace("Try", "Try ")
-                    outfile.write(",".join(line.split()) + "\n")
-        with open(
-            self.path
-            + "/"
-            + self.projname
-            + "_results/"
-            + str(i)
-            + "_"
-            + str(j)
-            + ".csv",
-            "r",
-        ) as f:
-            data = f.read()
-            with open(
-                self.path
-                + "/"
-                + self.projname
-                + "_results/"
-                + str(i)
-                + "_"
-                + str(j)
-                + ".csv",
-                "w",
-            ) as w:
-                w.write(data[:-1])
-
-    def prasa_results(self, filename, i):
-        # would be nice to find a way not to have two separate files...
-        resfile = os.path.join(
-            self.path, self.projname + "_results", "raw_prasa_" + str(i) + ".csv"
-        )
-        resfile_filt = os.path.join(
-            self.path, self.projname + "_results", "prasa_" + str(i) + ".csv"
-        )
-
-        with open(filename, "r") as infile, open(resfile, "w") as outfile:
-            filtered_file = ""
-            for line in infile:
-                if line.startswith("End of trial"):
-                    if not line.endswith(" 0\n"):
-                        outfile.write(line)
-                else:
-                    pass
-        self.replace(resfile, "End of trial ", "")
-        self.replace(resfile, "finalCC is ", "")
-        self.replace(resfile, "CCrange is ", "")
-        self.replace(resfile, "CCall is ", "")
-        self.replace(resfile, "(candidate for a solution)", "")
-        with open(resfile, "r") as file, open(resfile_filt, "w") as out:
-            for line in file:
-                lineout = line.replace(" ()", "")
-                lineout = str(i) + ", " + lineout
-                out.write(lineout)
-        # might have to use the w.write(data[:-1]) to get rid of last whitespace in file
-
-    def parse_prasa_txt(self, number, prasa_file_path):
-        with open(prasa_file_path, "r") as f:
-            lines = f.readlines()
-
-        candidate_data = []
-        number = float(number / 10)
-        for line in lines:
-            if line.startswith("End of trial") and line.rstrip().endswith(
-                "(candidate for a solution)"
+    def gather_results(self, pool, to_run, parsing=None):
+        # cells parsed while the jobs were running are used as they are, cells
+        # whose .lst is unchanged since the last parse come from the existing
+        # store and only the rest are parsed now. Returns everything in grid
+        # order, and the (i, j) of the cells that changed
+        parsing = parsing or {}
+        manifest = self.load_manifest()
+        stored = {}
+        if os.path.exists(self.trials_file()):
+            stored = {(i, j): cell for cell, i, j in split_cells(self.load_results())}
+        reuse = {}
+        for lstfile, i, j in to_run:
+            entry = manifest["cells"].get(str(i) + "_" + str(j), {})
+            if (i, j) in parsing or (i, j) not in stored:
+                continue
+            if entry.get("parsed") is not None and entry["parsed"] == fingerprint(
+                lstfile
             ):
-                stripped_line = "".join(
-                    filter(lambda x: x.isdigit() or x == "." or x == " ", line)
-                )
-                numbers = stripped_line.split()
-                candidate_data.append([number] + [float(num) for num in numbers])
-
-        return candidate_data
-
-    def process_prasa_file(self, number):
-        prasa_folder = os.path.join(self.projname, str(number), f"{number}_prasa")
-        prasa_file_path = os.path.join(prasa_folder, "prasa.txt")
-
-        if not os.path.exists(prasa_file_path):
-            return None
-
-        candidate_data = parse_prasa_txt(number, prasa_file_path)
+                reuse[(i, j)] = np.array(stored[(i, j)])
+        pending = [
+            cell for cell in to_run if (cell[1], cell[2]) not in parsing | reuse.keys()
+        ]
+        fresh = iter(pool.starmap(parse_cell, pending))
+        parsed = []
+        updated = set()
+        for lstfile, i, j in to_run:
+            if (i, j) in reuse:
+                parsed.append(reuse[(i, j)])
+                continue
+            parsed.append(parsing[(i, j)].get() if (i, j) in parsing else next(fresh))
+            updated.add((i, j))
+            entry = manifest["cells"].setdefault(
+                str(i) + "_" + str(j), {"res": i, "sites": j}
+            )
+            entry["parsed"] = fingerprint(lstfile)
+        print(f"Parsed {len(updated)} cells, {len(reuse)} unchanged")
+        self.save_manifest(manifest)
+        return parsed, updated
+
+    def trials_file(self):
+        return os.path.join(
+            self.path, self.projname + "_results", self.projname + "_trials.npy"
+        )
 
-        if candidate_data:
-            pdb_file_path = os.path.join(prasa_folder, "prasa.pdb")
-            copy_pdb = os.path.exists(pdb_file_path)
-        else:
-            copy_pdb = False
-
-        return (candidate_data, copy_pdb)
-
-    # def prasa_results_concurrent(self):
-    #     results_folder = f"{self.projname}_results"
-    #     pdbs_folder = os.path.join(results_folder, "pdbs")
-    #     os.makedirs(results_folder, exist_ok=True)
-    #     os.makedirs(pdbs_folder, exist_ok=True)
-
-    #     with Pool() as pool:
-    #         low = self.lowres * 10
-    #         high = self.highres * 10
-    #         args = [number for number in range(low, high)]
-    #         results = pool.starmap(self.process_prasa_file, args)
-
-    #     with open(os.path.join(results_folder, "prasa.csv"), 'w', newline='') as csvfile:
-    #         csv_writer = csv.writer(csvfile)
-    #         csv_writer.writerow(['res', 'CC', 'CCRange', 'CCAll'])
-
-    #         for (number, (candidate_data, copy_pdb)) in zip(range(low, high), results):
-    #             if candidate_data:
-    #                 for data in candidate_data:
-    #                     csv_writer.writerow(data)
-
-    #                 if copy_pdb:
-    #                     prasa_folder = os.path.join(self.projname, str(number), f"{number}_prasa")
-    #                     pdb_file_path = os.path.join(prasa_folder, "prasa.pdb")
-    #                     shutil.copy2(pdb_file_path, os.path.join(pdbs_folder, f"{number}_prasa.pdb"))
-
-    def run_sagasu_analysis(self):
-        ccoutliers_torun = []
+    def write_results(self, parsed):
+        # written aside and moved into place, the old store may still be mapped
+        with open(self.trials_file() + ".tmp", "wb") as f:
+            np.save(f, np.concatenate(parsed))
+        os.replace(self.trials_file() + ".tmp", self.trials_file())
+
+    def load_results(self):
+        return np.load(self.trials_file(), mmap_mode="r")
+
+    def prasa_table(self, pool, prasaruns):
+        # every <res>_prasa/prasa.txt parsed at once into one table, written
+        # to <proj>_results/prasa.csv, with the candidate prasa.pdb files
+        # collected in <proj>_results/pdbs/<res>_prasa.pdb
+        rows = [row for rows in pool.starmap(parse_prasa, prasaruns) for row in rows]
+        prasa = pd.DataFrame(rows, columns=PRASA_COLUMNS)
+        results = os.path.join(self.path, self.projname + "_results")
+        prasa.to_csv(os.path.join(results, "prasa.csv"), index=False)
+        pdbs = os.path.join(results, "pdbs")
+        os.makedirs(pdbs, exist_ok=True)
+        for i in sorted(set(prasa["res"][prasa["candidate"]])):
+            number = int(round(i * 10))
+            pdb = os.path.join(
+                self.path, self.projname, str(number), f"{number}_prasa", "prasa.pdb"
+            )
+            if os.path.exists(pdb):
+                shutil.copy2(pdb, os.path.join(pdbs, f"{number}_prasa.pdb"))
+        print(f"PRASA: {len(prasa)} trials, {int(prasa['candidate'].sum())} candidates")
+        return prasa
+
+    def for_ML_analysis(self, trials, updated=None):
+        # start/end rows of the cells that changed since their figure was
+        # drawn, every cell when that is not known
         if not os.path.exists(self.projname + "_figures"):
             os.mkdir(self.projname + "_figures")
-        i = self.highres
-        while not (i >= self.lowres):
-            i2 = i / 10
-            j = self.highsites
-            while not (j <= (self.lowsites - 1)):
-                csvfile = os.path.join(
-                    self.path,
-                    self.projname + "_results/" + str(i) + "_" + str(j) + ".csv",
-                )
-                ccoutliers_torun.append((csvfile, i, j))
-                j = j - 1
-            i = i + 1
-        return ccoutliers_torun
+        if trials.size == 0:
+            return []
+        starts, ends = cell_bounds(trials)
+        res, sites = trials["RES"][starts].tolist(), trials["SITES"][starts].tolist()
+        return [
+            ((a, b), str(i) + "_" + str(j))
+            for a, b, i, j in zip(starts.tolist(), ends.tolist(), res, sites)
+            if updated is None
+            or (i, j) in updated
+            or not os.path.exists(self.ml_figure(str(i) + "_" + str(j)))
+        ]
 
-    def for_ML_analysis(self):
-        to_run_ML = []
-        if not os.path.exists(self.projname + "_figures"):
-            os.mkdir(self.projname + "_figures")
-        i = self.highres
-        while not (i >= self.lowres):
-            i2 = i / 10
-            j = self.highsites
-            while not (j <= (self.lowsites - 1)):
-                csvfile = os.path.join(
-                    self.path,
-                    self.projname + "_results/" + str(i) + "_" + str(j) + ".csv",
-                )
-                numbers = str(i) + "_" + str(j)
-                to_run_ML.append((csvfile, numbers))
-                j = j - 1
-            i = i + 1
-        return to_run_ML
-
-    def plot_for_ML(self, filename, nums):
-        df = pd.read_csv(
-            filename,
-            sep=",",
-            names=[
-                "linebeg",
-                "TRY",
-                "CPUNO",
-                "CCALL",
-                "CCWEAK",
-                "CFOM",
-                "BEST",
-                "PATFOM",
-            ],
-        )
-        plt.scatter(df["CCWEAK"], df["CCALL"], marker="o")
-        plt.draw()
-        ccallvsccweak = plt.gcf()
-        ccallvsccweak.savefig(
-            self.path
-            + "/"
-            + self.projname
-            + "_figures/"
-            + self.projname
-            + "_"
-            + nums
-            + "_ML.png",
-            dpi=500,
-            bbox_inches=0,
-        )
-        ccallvsccweak.clear()
-        plt.close(ccallvsccweak)
-
-    def CFOM_PATFOM_analysis(self, filename, resolution, sitessearched):
-        df = pd.read_csv(
-            filename,
-            sep=",",
-            names=[
-                "linebeg",
-                "TRY",
-                "CPUNO",
-                "CCALL",
-                "CCWEAK",
-                "CFOM",
-                "BEST",
-                "PATFOM",
-            ],
+    def ml_figure(self, nums):
+        return os.path.join(
+            self.path,
+            self.projname + "_figures",
+            self.projname + "_" + nums + "_ML.png",
         )
-        pd.DataFrame.drop(df, labels="linebeg", axis=1, inplace=True)
-        df.sort_values("CFOM", ascending=False, inplace=True, na_position="last")
-        top_CFOM = df["CFOM"].values[0]
-        corr_PATFOM = df["PATFOM"].values[0]
-        with open(self.projname + "_results/CFOM_PATFOM.csv", "a") as allfom:
-            allfom.write(
-                str(int(resolution) / 10)
-                + ","
-                + str(sitessearched)
-                + ","
-                + str(top_CFOM)
-                + ","
-                + str(corr_PATFOM)
-                + "\n"
-            )
 
-    def ccalloutliers(self, filename, resolution, sitessearched):
-        df = pd.read_csv(
-            filename,
-            sep=",",
-            names=[
-                "linebeg",
-                "TRY",
-                "CPUNO",
-                "CCALL",
-                "CCWEAK",
-                "CFOM",
-                "BEST",
-                "PATFOM",
-            ],
-        )
-        pd.DataFrame.drop(df, labels="linebeg", axis=1, inplace=True)
-        median = df["CCALL"].median()
-        arr = df[["CCALL", "CCWEAK"]].to_numpy()
-        cmean = arr.mean(axis=1)
-        csd = arr.std(axis=1)
-        # outliermask = ((arr[:, 0]) > (cmean[0] - (2 * csd[0]))) & (
-        #     (arr[:, 1]) > (cmean[1] - (2 * csd[1]))
-        # )
-        # chaging outlier mask to remove anything below the centroid in either direction
-        outliermask = ((arr[:, 0]) > (cmean[0])) & ((arr[:, 1]) > (cmean[1]))
-        arr = arr[outliermask]
-        mad = np.median(np.sqrt((arr[:, 0] - median) ** 2))
-        ccallmad = arr[:, 0] - median
-        mad10 = sum(i > 10 * mad for i in ccallmad)
-        mad9 = sum(i > 9 * mad for i in ccallmad)
-        mad8 = sum(i > 8 * mad for i in ccallmad)
-        mad7 = sum(i > 7 * mad for i in ccallmad)
-        mad6 = sum(i > 6 * mad for i in ccallmad)
-        mad5 = sum(i > 5 * mad for i in ccallmad)
-        allmad = open(self.projname + "_results/ccall.csv", "a")
-        allmad.write(
-            str(int(resolution) / 10)
-            + ","
-            + str(sitessearched)
-            + ","
-            + str(mad5)
-            + ","
-            + str(mad6)
-            + ","
-            + str(mad7)
-            + ","
-            + str(mad8)
-            + ","
-            + str(mad9)
-            + ","
-            + str(mad10)
-            + "\n"
-        )
-        allmad.close()
-
-    def ccweakoutliers(self, filename, resolution, sitessearched):
-        df = pd.read_csv(
-            filename,
-            sep=",",
-            names=[
-                "linebeg",
-                "TRY",
-                "CPUNO",
-                "CCALL",
-                "CCWEAK",
-                "CFOM",
-                "BEST",
-                "PATFOM",
-            ],
-        )
-        pd.DataFrame.drop(df, labels="linebeg", axis=1, inplace=True)
-        median = df["CCWEAK"].median()
-        arr = df[["CCALL", "CCWEAK"]].to_numpy()
-        cmean = arr.mean(axis=0)
-        # csd = arr.std(axis=0)
-        # outliermask = ((arr[:, 0]) > (cmean[0] - (2 * csd[0]))) & (
-        #     (arr[:, 1]) > (cmean[1] - (2 * csd[1]))
-        # )
-        outliermask = ((arr[:, 0]) > (cmean[0])) & ((arr[:, 1]) > (cmean[1]))
-        arr = arr[outliermask]
-        mad = np.median(np.sqrt((arr[:, 1] - median) ** 2))
-        ccweakmad = arr[:, 1] - median
-        mad10 = sum(i > 10 * mad for i in ccweakmad)
-        mad9 = sum(i > 9 * mad for i in ccweakmad)
-        mad8 = sum(i > 8 * mad for i in ccweakmad)
-        mad7 = sum(i > 7 * mad for i in ccweakmad)
-        mad6 = sum(i > 6 * mad for i in ccweakmad)
-        mad5 = sum(i > 5 * mad for i in ccweakmad)
-        allmad = open(self.projname + "_results/ccweak.csv", "a")
-        allmad.write(
-            str(int(resolution) / 10)
-            + ","
-            + str(sitessearched)
-            + ","
-            + str(mad5)
-            + ","
-            + str(mad6)
-            + ","
-            + str(mad7)
-            + ","
-            + str(mad8)
-            + ","
-            + str(mad9)
-            + ","
-            + str(mad10)
-            + "\n"
-        )
-        allmad.close()
-
-    def vectoroutliers_analysis(self, filename, resolution, sitessearched):
-        df = pd.read_csv(
-            filename,
-            sep=",",
-            names=[
-                "linebeg",
-                "TRY",
-                "CPUNO",
-                "CCALL",
-                "CCWEAK",
-                "CFOM",
-                "BEST",
-                "PATFOM",
-            ],
-        )
-        pd.DataFrame.drop(
-            df,
-            labels=["linebeg", "CPUNO", "BEST", "TRY", "CFOM", "PATFOM"],
-            axis=1,
-            inplace=True,
-        )
-        ccall_mean = df["CCALL"].mean()
-        ccweak_mean = df["CCWEAK"].mean()
-        df["CCALL_VEC"] = df["CCALL"] - ccall_mean
-        df["CCWEAK_VEC"] = df["CCWEAK"] - ccweak_mean
-        df = df[df["CCALL_VEC"] > 0]
-        df = df[df["CCWEAK_VEC"] > 0]
-        df["VEC_DIFF"] = np.absolute(df["CCALL_VEC"] - df["CCWEAK_VEC"])
-        df["COMB_VEC"] = np.sqrt(
-            np.square(df["CCALL_VEC"]) + np.square(df["CCWEAK_VEC"])
+    def plot_ML(self, pool, trials, updated=None, ranking=None):
+        # per-cell figures go out in one batch per pool worker, each batch on
+        # its own reusable canvas. updated is what gather_results returns,
+        # ranking what rank_solutions returns, for the explorer
+        start = time.perf_counter()
+        count = 0
+        figures = {"cells": [], "tiled": None}
+        if self.plot_mode in ("cells", "both"):
+            to_run_ML = self.for_ML_analysis(trials, updated)
+            nbatch = max(1, min(len(to_run_ML), os.cpu_count()))
+            batches = [to_run_ML[n::nbatch] for n in range(nbatch)]
+            count += sum(
+                pool.starmap(
+                    plot_cells,
+                    [
+                        (
+                            self.trials_file(),
+                            [bounds for bounds, nums in batch],
+                            [self.ml_figure(nums) for bounds, nums in batch],
+                            self.plot_dpi,
+                        )
+                        for batch in batches
+                    ],
+                )
+            )
+        if self.plot_mode in ("tiled", "both"):
+            plot_tiled(
+                split_cells(trials),
+                os.path.join(
+                    self.path,
+                    self.projname + "_figures",
+                    self.projname + "_cells.png",
+                ),
+                self.plot_dpi,
+            )
+            count += 1
+            figures["tiled"] = (
+                self.projname + "_figures/" + self.projname + "_cells.png"
+            )
+        if self.plot_mode in ("cells", "both"):
+            # every cell of the grid, including figures kept from a last run
+            figures["cells"] = [
+                os.path.relpath(self.ml_figure(str(i) + "_" + str(j)), self.path)
+                for cell, i, j in split_cells(trials)
+            ]
+        self.write_explorer(trials, ranking)
+        elapsed = time.perf_counter() - start
+        print(f"{count} figures and the explorer in {elapsed:.1f} s")
+        return figures
+
+    def explorer_file(self):
+        return os.path.join(
+            self.path, self.projname + "_figures", self.projname + "_explorer.html"
         )
-        df["NORM_VEC_DIFF"] = (df["VEC_DIFF"] / df["VEC_DIFF"].abs().max()) + 0.000001
-        df["NORM_COMB_VEC"] = (df["COMB_VEC"] / df["COMB_VEC"].abs().max()) + 0.000001
-        df["WEIGHTED"] = np.power(df["NORM_COMB_VEC"], 18) / np.cbrt(
-            df["NORM_VEC_DIFF"]
+
+    def write_explorer(self, trials, ranking=None):
+        if ranking is None:
+            ranking = pd.DataFrame(columns=["res", "sites", "score"])
+        sagasu_report.write_explorer(
+            self.explorer_file(),
+            self.projname,
+            sagasu_report.explorer_payload(split_cells(trials), ranking),
         )
-        df = df[df["WEIGHTED"] > 0.1]
-        df["RES"] = resolution / 10
-        df["SITES"] = sitessearched
-        return df
-
-    def vectoroutliers(self):
-        all_data = pd.DataFrame()
-        for resrange in range(self.highres, self.lowres):
-            for siterange in range(self.lowsites, self.highsites):
-                filename = os.path.join(
-                    self.path,
-                    self.projname
-                    + "_results/"
-                    + str(resrange)
-                    + "_"
-                    + str(siterange)
-                    + ".csv",
+
+    def write_summaries(self, ccall, ccweak, cfom):
+        # the grid-order tables of mad_outliers and cfom_patfom
+        for name, df in (("ccall", ccall), ("ccweak", ccweak), ("CFOM_PATFOM", cfom)):
+            df.to_csv(
+                os.path.join(self.path, self.projname + "_results", name + ".csv"),
+                header=False,
+                index=False,
+            )
+        return ccall, ccweak, cfom
+
+    def vectoroutliers(self, trials, max_points=20000, bins=200):
+        # every trial of the grid goes into a binned density background, only
+        # the strongest max_points vector outliers are drawn as points, with
+        # WebGL, so the page size does not grow with the grid
+        all_data = vector_outliers(trials)
+        if len(all_data) > max_points:
+            strongest = np.argpartition(-all_data["COMB_VEC"].to_numpy(), max_points)
+            all_data = all_data.iloc[strongest[:max_points]]
+        all_data = all_data.sort_values(by=["COMB_VEC"], ascending=False)
+        fig = go.Figure()
+        if trials.size:
+            counts, xedges, yedges = np.histogram2d(
+                trials["CCWEAK"], trials["CCALL"], bins=bins
+            )
+            density = np.full(counts.T.shape, np.nan)
+            np.log10(counts.T, out=density, where=counts.T > 0)
+            fig.add_trace(
+                go.Heatmap(
+                    x=(xedges[:-1] + xedges[1:]) / 2,
+                    y=(yedges[:-1] + yedges[1:]) / 2,
+                    z=density,
+                    colorscale="Greys",
+                    showscale=False,
+                    hovertemplate="CCWeak: %{x:.1f}<br>CCAll: %{y:.1f}<extra></extra>",
+                    name="all trials",
                 )
-                data = self.vectoroutliers_analysis(filename, resrange, siterange)
-                all_data = pd.concat([all_data, data], axis=0, ignore_index=True)
-        all_data.sort_values(by=["COMB_VEC"], axis=0, inplace=True, ascending=False)
+            )
         customdata = np.stack(
             (all_data["RES"], all_data["SITES"], all_data["COMB_VEC"]), axis=1
         )
-        fig = px.scatter(
-            all_data,
-            x="CCWEAK",
-            y="CCALL",
-            color="COMB_VEC",
-            color_continuous_scale="Bluered_r",
-        )
         hovertemplate = (
             "Res: %{customdata[0]} Å<br>"
             + "Sites: %{customdata[1]}<br>"
@@ -812,72 +1625,144 @@ eof
             + "CCAll: %{y}"
             + "<extra></extra>"
         )
-        fig.update_traces(customdata=customdata, hovertemplate=hovertemplate)
+        fig.add_trace(
+            go.Scattergl(
+                x=all_data["CCWEAK"],
+                y=all_data["CCALL"],
+                mode="markers",
+                marker=dict(
+                    color=all_data["COMB_VEC"],
+                    colorscale="Bluered_r",
+                    showscale=True,
+                    size=5,
+                ),
+                customdata=customdata,
+                hovertemplate=hovertemplate,
+                name="vector outliers",
+            )
+        )
+        fig.update_layout(xaxis_title="CCWEAK", yaxis_title="CCALL")
         fig.write_html(self.projname + "_figures/vectoroutliers.html")
 
-    def tophits(self):
-        df = pd.read_csv(
-            self.projname + "_results/ccall.csv",
-            sep=",",
-            names=["res", "sites", "mad5", "mad6", "mad7", "mad8", "mad9", "mad10"],
+    def tophits(self, ccall=None, ccweak=None, cfom=None):
+        # summaries can be handed over from the analysis or read back from disk
+        mad_names = ["res", "sites", "mad5", "mad6", "mad7", "mad8", "mad9", "mad10"]
+        if ccall is None:
+            ccall = pd.read_csv(self.projname + "_results/ccall.csv", names=mad_names)
+        if ccweak is None:
+            ccweak = pd.read_csv(self.projname + "_results/ccweak.csv", names=mad_names)
+        if cfom is None:
+            cfom = pd.read_csv(
+                self.projname + "_results/CFOM_PATFOM.csv",
+                names=["res", "sites", "CFOM", "PATFOM"],
+            )
+        if len(ccall) < 2:
+            raise RuntimeError(
+                f"{len(ccall)} cells with SHELXD trials, check the .lst files in "
+                + os.path.join(self.path, self.projname)
+            )
+        df = ccall.copy()
+        df["score"] = mad_score(df)
+        # the report is written from these, nothing is kept on core. Only
+        # the top rows of each table are sorted
+        hits = {"ccall": top_k(df, "score")}
+        weak_df = ccweak.copy()
+        weak_df["score"] = mad_score(weak_df)
+        hits["ccweak"] = top_k(weak_df, "score")
+        cfom_df = cfom.copy()
+        cfom_df["score"] = cfom_score(cfom_df)
+        hits["cfom"] = top_k(cfom_df, "CFOM")
+        with open("tophits.txt", "w") as outfile:
+            outfile.write(
+                "\n".join(
+                    str(hits[key].reset_index(drop=True))
+                    for key in ("ccall", "ccweak", "cfom")
+                )
+            )
+        hits["surfaces"] = []
+        if self.plot_mode != "lazy":
+            # the explorer page colours the grid by these scores on demand
+            hits["surfaces"] = self.score_surfaces(df, weak_df, cfom_df)
+        # the top 2 CCALL compared in process, like the pairs of the EMMA matrix
+        top = hits["ccall"]
+        (firstres, firstsites, secondres, secondsites) = (
+            top.iloc[[0], [0]].values[0],
+            top.iloc[[0], [1]].values[0],
+            top.iloc[[1], [0]].values[0],
+            top.iloc[[1], [1]].values[0],
         )
-        df["score"] = (
-            (df["mad5"] * 1)
-            + (df["mad6"] * 4)
-            + (df["mad7"] * 8)
-            + (df["mad8"] * 32)
-            + (df["mad9"] * 128)
-            + (df["mad10"] * 512)
+        (firstres, firstsites, secondres, secondsites) = (
+            ((firstres * 10).astype(np.int32)).item(0),
+            (firstsites.astype(np.int32)).item(0),
+            ((secondres * 10).astype(np.int32)).item(0),
+            (secondsites.astype(np.int32)).item(0),
         )
-        df.sort_values(by=["score"], ascending=False, inplace=True)
-        top = df[["res", "sites", "score"]]
-        top = df.head(10)
-        self.topallhtml = top.reset_index(drop=True).to_html()
-        self.topall = str(top.reset_index(drop=True))
-        weak_df = pd.read_csv(
-            self.projname + "_results/ccweak.csv",
-            sep=",",
-            names=["res", "sites", "mad5", "mad6", "mad7", "mad8", "mad9", "mad10"],
+        first, second = (
+            os.path.join(self.cellpath(res, sites), self.projname + "_fa.pdb")
+            for res, sites in ((firstres, firstsites), (secondres, secondsites))
         )
-        weak_df["score"] = (
-            (weak_df["mad5"] * 1)
-            + (weak_df["mad6"] * 4)
-            + (weak_df["mad7"] * 8)
-            + (weak_df["mad8"] * 32)
-            + (weak_df["mad9"] * 128)
-            + (weak_df["mad10"] * 512)
+        emma = emma_text(
+            emma_compare(first, second, self.unitcell, self.spacegroup, tolerance=6)
         )
-        weak_df.sort_values(by=["score"], ascending=False, inplace=True)
-        top = weak_df[["res", "sites", "score"]]
-        top = weak_df.head(10)
-        self.topweakhtml = top.reset_index(drop=True).to_html()
-        self.topweak = str(top.reset_index(drop=True))
-        cfom_df = pd.read_csv(
-            self.projname + "_results/CFOM_PATFOM.csv",
-            sep=",",
-            names=["res", "sites", "CFOM", "PATFOM"],
+        # linked from the report rather than inlined
+        hits["emma"] = self.projname + "_results/emma_top2.txt"
+        with open(hits["emma"], "w") as outfile:
+            outfile.write(emma)
+        hits["emma_models"] = str(
+            "First model - "
+            + str(float(firstres / 10))
+            + " Å with a sites cutoff of "
+            + str(firstsites)
+            + "\n"
+            + "Second model - "
+            + str(float(secondres / 10))
+            + " Å with a sites cutoff of "
+            + str(secondsites)
         )
-        cfom_df.sort_values("CFOM", ascending=False, inplace=True)
-        cfom_df["score"] = (
-            (cfom_df["CFOM"])
-            - (((cfom_df["res"])) * (cfom_df["res"]))
-            - (0.3 * (cfom_df["sites"]))
+        return hits
+
+    def rank_solutions(self, ccall, ccweak, cfom, prasa=None, top=10):
+        # SHELXD and PRASA (the table prasa_table returns) ranked together.
+        # The substructure agreement is only worked out for the leading
+        # cells, against the PRASA candidate at the same resolution
+        if prasa is None:
+            prasa = pd.DataFrame(columns=PRASA_COLUMNS)
+        ranking = joint_ranking(ccall, ccweak, cfom, prasa)
+        agreement = {}
+        for res, sites in zip(ranking["res"].head(top), ranking["sites"].head(top)):
+            key, sites = int(round(res * 10)), int(sites)
+            prasa_pdb = os.path.join(
+                self.path, self.projname, str(key), f"{key}_prasa", "prasa.pdb"
+            )
+            shelxd_pdb = os.path.join(
+                self.cellpath(key, sites), self.projname + "_fa.pdb"
+            )
+            if not (os.path.exists(prasa_pdb) and os.path.exists(shelxd_pdb)):
+                continue
+            try:
+                pairs, n1, n2, rms = emma_match(shelxd_pdb, prasa_pdb, self.symmetry())
+            except Exception as e:
+                print(f"Could not compare {shelxd_pdb} with PRASA: {e}")
+                continue
+            agreement[(key, sites)] = pairs / min(n1, n2) if min(n1, n2) else 0.0
+        if agreement:
+            ranking = joint_ranking(ccall, ccweak, cfom, prasa, agreement)
+        ranking.to_csv(
+            os.path.join(self.path, self.projname + "_results", "ranking.csv"),
+            index=False,
         )
-        top = cfom_df.head(10)
-        self.top_CFOMhtml = top.reset_index(drop=True).to_html()
-        self.top_CFOM = str(top.reset_index(drop=True))
-        with open("tophits.txt", "w") as outfile:
-            outfile.write(self.topall)
-            outfile.write("\n")
-            outfile.write(self.topweak)
+        with open("tophits.txt", "a") as outfile:
             outfile.write("\n")
-            outfile.write(self.top_CFOM)
+            outfile.write(ranking.head(top).to_string())
+        return ranking
+
+    def score_surfaces(self, df, weak_df, cfom_df):
         ax = plt.axes(projection="3d")
         ax.plot_trisurf(
             df["res"], df["sites"], df["score"], cmap="viridis", edgecolor="none"
         )
         madplot = plt.gcf()
-        madplot.savefig(self.projname + "_figures/ccall.png", dpi=600)
+        madplot.savefig(self.projname + "_figures/ccall.png", dpi=self.plot_dpi)
         plt.clf()
         plt.cla()
         plt.close()
@@ -890,7 +1775,7 @@ eof
             edgecolor="none",
         )
         madplot = plt.gcf()
-        madplot.savefig(self.projname + "_figures/ccweak.png", dpi=600)
+        madplot.savefig(self.projname + "_figures/ccweak.png", dpi=self.plot_dpi)
         plt.clf()
         plt.cla()
         plt.close()
@@ -903,111 +1788,88 @@ eof
             edgecolor="none",
         )
         madplot = plt.gcf()
-        madplot.savefig(self.projname + "_figures/CFOM.png", dpi=600)
-        # run phenix.emma on top 2 CCALL
-        top = df[["res", "sites", "score"]]
-        top = df.head(10)
-        (firstres, firstsites, secondres, secondsites) = (
-            top.iloc[[0], [0]].values[0],
-            top.iloc[[0], [1]].values[0],
-            top.iloc[[1], [0]].values[0],
-            top.iloc[[1], [1]].values[0],
-        )
-        (firstres, firstsites, secondres, secondsites) = (
-            ((firstres * 10).astype(np.int32)).item(0),
-            (firstsites.astype(np.int32)).item(0),
-            ((secondres * 10).astype(np.int32)).item(0),
-            (secondsites.astype(np.int32)).item(0),
-        )
-        with open(
-            self.path
-            + "/"
-            + self.projname
-            + "/"
-            + str(firstres)
-            + "/"
-            + str(firstsites)
-            + "/"
-            + self.projname
-            + "_fa.res",
-            "r",
-        ) as infile:
-            for line in infile:
-                if line.startswith("TITL"):
-                    words = line.split()
-                    self.sg = words[-1]
-        self.emma = os.popen(
-            "module load phenix && phenix.emma "
-            + str(
-                os.path.join(
-                    self.path,
-                    self.projname,
-                    str(firstres),
-                    str(firstsites),
-                    (self.projname + "_fa.pdb "),
-                )
-                + os.path.join(
-                    self.path,
-                    self.projname,
-                    str(secondres),
-                    str(secondsites),
-                    (self.projname + "_fa.pdb"),
-                )
-                + " --tolerance=6 --space_group="
-                + self.sg
+        madplot.savefig(self.projname + "_figures/CFOM.png", dpi=self.plot_dpi)
+        plt.close()
+        return [
+            self.projname + "_figures/" + name + ".png"
+            for name in ("ccall", "ccweak", "CFOM")
+        ]
+
+    def get_filenames_for_emma(self, ranking=None, top=10):
+        # only the leading cells of the ranking (or of the CCall scores without
+        # one) are compared, top*(top-1)/2 pairs rather than every pair of the
+        # grid. Returns the files and the pairs
+        if ranking is not None:
+            leading = ranking
+        else:
+            leading = pd.read_csv(
+                self.projname + "_results/ccall.csv",
+                names=["res", "sites"] + ["mad" + str(k) for k in MAD_MULTIPLIERS],
             )
-        ).read()
-        self.emmain = str(
-            "First model - "
-            + str(float(firstres / 10))
-            + " Å with a sites cutoff of "
-            + str(firstsites)
-            + "\n"
-            + "Second model - "
-            + str(float(secondres / 10))
-            + " Å with a sites cutoff of "
-            + str(secondsites)
+            leading = leading.assign(score=mad_score(leading)).sort_values(
+                "score", ascending=False
+            )
+        pdb_files = []
+        for res, sites in zip(leading["res"], leading["sites"]):
+            pdb = os.path.join(
+                self.cellpath(int(round(res * 10)), int(sites)),
+                self.projname + "_fa.pdb",
+            )
+            if os.path.exists(pdb):
+                pdb_files.append(pdb)
+            if len(pdb_files) == top:
+                break
+        parallel_filelist = list(combinations(pdb_files, 2))
+        print(f"{len(parallel_filelist)} EMMA comparisons")
+        return pdb_files, parallel_filelist
+
+    def emma_comparisons(self, pool, parallel_filelist, tolerance=3.0):
+        # results are kept in <proj>_results/emma_cache.json under the hashes
+        # of both files, so only new or changed pairs are compared
+        cachefile = os.path.join(
+            self.path, self.projname + "_results", "emma_cache.json"
         )
-
-    def run_emma(self, emma_1, emma_2):
-        command = f"module load phenix > /dev/null 2>&1 && phenix.emma --symmetry=aimless.mtz {str(emma_1)} {str(emma_2)}"
-        result = subprocess.run(command, stdout=subprocess.PIPE, shell=True)
-        # filename1 = str(os.path.basename(os.path.dirname(os.path.dirname(emma_1)))) + str(os.path.basename(os.path.dirname(emma_1)))
-        # filename2 = str(os.path.basename(os.path.dirname(os.path.dirname(emma_2)))) + str(os.path.basename(os.path.dirname(emma_2)))
-        # output = os.path.join(self.path, f"{self.projname}_results", f"{filename1}_{filename2}")
-        #     with open(output, "w") as emmafile:
-        #         emmafile.write(result.stdout.decode("utf-8"))
-        return (emma_1, emma_2, result.stdout.decode("utf-8"))
-
-    def get_filenames_for_emma(self):
-        self.pdb_files_for_emma = [
-            os.path.join(
-                os.getcwd(), f"{self.projname}/{str(i)}/{str(j)}/{self.projname}_fa.pdb"
+        cache = {}
+        if os.path.exists(cachefile):
+            with open(cachefile) as f:
+                cache = json.load(f)
+        hashes = {pdb: file_hash(pdb) for pair in parallel_filelist for pdb in pair}
+        keys = [
+            "_".join(
+                [hashes[a], hashes[b], self.unitcell, self.spacegroup, str(tolerance)]
             )
-            for i in range(self.highres, self.lowres)
-            for j in range(self.lowsites, self.highsites)
+            for a, b in parallel_filelist
         ]
-        parallel_filelist = list(combinations(self.pdb_files_for_emma, 2))
-        print(len(parallel_filelist))
-        # with open("parallel_filelist.txt", 'w') as file:
-        #     for line in parallel_filelist:
-        #         file.write(str(line) + '\n')
-        return parallel_filelist
-
-    def emma_correlation_plot(self, emma_results):
+        missing = {
+            key: (a, b, self.unitcell, self.spacegroup, tolerance)
+            for (a, b), key in zip(parallel_filelist, keys)
+            if key not in cache
+        }
+        print(f"{len(keys) - len(missing)} EMMA results cached")
+        for key, match in zip(missing, pool.starmap(emma_compare, missing.values())):
+            if match is not None:
+                cache[key] = match
+        with open(cachefile, "w") as f:
+            json.dump(cache, f)
+        return [
+            (a, b, emma_text(cache.get(key)))
+            for (a, b), key in zip(parallel_filelist, keys)
+        ]
+
+    def emma_correlation_plot(self, pdb_files, emma_results):
         pairs_pattern = r"Pairs:\s*(\d+)"
         singles_model1_pattern = r"Singles model 1:\s*(\d+)"
         singles_model2_pattern = r"Singles model 2:\s*(\d+)"
 
         percentages = []
 
-        for file in self.pdb_files_for_emma:
+        for file in pdb_files:
             filename = (
                 str(os.path.basename(os.path.dirname(os.path.dirname(file))))
                 + "_"
                 + str(os.path.basename(os.path.dirname(file)))
             )
-            diagonalval = [str(filename), str(filename), str(1)]
+            diagonalval = [str(filename), str(filename), 1.0]
             percentages.append(diagonalval)
 
         for file1, file2, output in emma_results:
@@ -1020,7 +1882,8 @@ eof
                 singles_model1_number = singles_model1_match.group(1)
                 singles_model2_number = singles_model2_match.group(1)
             else:
-                pass
+                # comparison failed, the pair is left at 0
+                continue
 
             if pairs_number and singles_model1_number and singles_model2_number:
                 percentage = np.around(
@@ -1044,7 +1907,7 @@ eof
                     + "_"
                     + str(os.path.basename(os.path.dirname(file2)))
                 )
-                percentages.append([str(filename1), str(filename2), str(percentage)])
+                percentages.append([str(filename1), str(filename2), float(percentage)])
             else:
                 pass
 
@@ -1073,106 +1936,12 @@ eof
         fig.write_html(self.projname + "_figures/emmamatrix.html")
         print("Written emma file")
 
-    def writehtml(self):
-        self.html_init = """
-        <!doctype html>
-        <html>
-        <head>
-            <title>Sagasu - SHELXD Grid</title>
-            <style>
-            background: linear-gradient(0deg, #e4fffd 0%, #60f3ff 100%);
-            </style>
-        </head>
-        <body>
-        <h1 style="text-align: center;"><span style="font-family:courier new,courier,monospace;">Sagasu - SHELXD Grid Search </span></h1>
-
-        <p><span style="font-family:courier new,courier,monospace;">Results for project <strong>{projname}</strong>, <strong>{ntry}</strong> trys with a low resolution limit of <strong>{lowres}</strong> and a high resolution limit of <strong>{highres}</strong>, searching for a number of sites between <strong>{lowsites}</strong> and <strong>{highsites}</strong>.</span></p>
-
-        <hr />
-        
-        <p><a href="./{projname}_figures/vectoroutliers.html">Vector Outliers Overview</a></p>
-        
-        <p><a href="./{projname}_figures/emmamatrix.html">Phenix EMMA Correlation Heatmap</a></p>
-        """.format(
-            projname=self.projname,
-            ntry=str(self.ntry),
-            lowres=str(float(self.lowres / 10)),
-            highres=str(float(self.highres / 10)),
-            lowsites=str(self.lowsites),
-            highsites=str(self.highsites),
+    def writehtml(self, hits, ranking=None, figures=None):
+        # hits from tophits and figures from plot_ML, paths relative to the page
+        sagasu_report.write_report(
+            os.path.join(self.path, self.projname + "_sagasu.html"),
+            self,
+            hits,
+            ranking,
+            figures,
         )
-
-        self.html_topten = """
-        <p><span style="font-family:courier new,courier,monospace;"><span style="font-size:18px;"><strong><u>Here are the top 10 hits:</u></strong></span></span></p>
-
-        <p><span style="font-family:courier new,courier,monospace;"><strong>For CCALL:</strong></span></p>
-
-        <p><span style="font-family:courier new,courier,monospace;">{CCALL_tophits}</span></p>
-
-        <p><span style="font-family:courier new,courier,monospace;"><strong>For CCWEAK:</strong></span></p>
-
-        <p><span style="font-family:courier new,courier,monospace;">{CCWEAK_tophits}</span></p>
-
-        <p><span style="font-family:courier new,courier,monospace;"><strong>For CFOM:</strong></span></p>
-
-        <p><span style="font-family:courier new,courier,monospace;">{CFOM_tophits}</span></p>
-
-        <hr />
-        <p><span style="font-family:courier new,courier,monospace;">phenix.emma output:</span></p>
-        <p><span style="font-family:courier new,courier,monospace; white-space: pre-line">
-        """.format(
-            CCALL_tophits=str(self.topallhtml),
-            CCWEAK_tophits=str(self.topweakhtml),
-            CFOM_tophits=str(self.top_CFOMhtml),
-        )
-
-        with open(f"{self.projname}_sagasu.html", "w") as htmlfile:
-            htmlfile.write(self.html_init + "\n")
-        with open(f"{self.projname}_sagasu.html", "a") as htmlfile:
-            htmlfile.write(self.html_topten + "\n")
-            htmlfile.write(self.emmain + "\n")
-            for line in self.emma.splitlines():
-                htmlfile.write(line + "\n")
-            htmlfile.write("</span></p>" + "\n")
-            htmlfile.write(
-                """<hr />
-                <p><span style="font-family:courier new,courier,monospace;"><span style="font-size:18px;"><strong><u>Plots:</u></strong></span></span></p>"""
-            )
-            htmlfile.write(
-                """
-                <table><tbody><tr>
-                <th><p><img title="{projname} CCALL" src="{projname}_figures/ccall.png" style="float: left; border-width: 2px; border-style: solid; width: 768px; height: 576px;" /></th>
-            """.format(
-                    projname=self.projname
-                )
-            )
-            htmlfile.write(
-                """
-                <th><p><img title="{projname} CCWEAK" src="{projname}_figures/ccweak.png" style="float: left; border-width: 2px; border-style: solid; width: 768px; height: 576px;" /></th>
-            """.format(
-                    projname=self.projname
-                )
-            )
-            htmlfile.write(
-                """
-                <th><p><img title="{projname} CFOM" src="{projname}_figures/CFOM.png" style="float: left; border-width: 2px; border-style: solid; width: 768px; height: 576px;" /></th>
-                </tr></tbody></table>
-            """.format(
-                    projname=self.projname
-                )
-            )
-            for plot in sorted(
-                glob.glob(os.path.join(self.path, (self.projname + "_figures"), "*ML*"))
-            ):
-                htmlfile.write(
-                    """
-                <p><img title="{plot}" src="{plot}" style="float: left; border-width: 2px; border-style: solid; width: 420px; height: 320px;" />
-                """.format(
-                        plot=str(plot)
-                    )
-                )
-            htmlfile.write(
-                """</p>
-        </body>
-        </html>"""
-            )
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import sagasu_core
 import os
+import pandas as pd
 import sys
 from multiprocessing import Pool
 
@@ -10,18 +11,7 @@ print("Using ", str(os.cpu_count() - 1), "CPU cores")
 path = os.getcwd()
 ml_plots = sagasu_core.core()
 
-(
-    projname,
-    lowres,
-    highres,
-    lowsites,
-    highsites,
-    ntry,
-    clusteranalysis,
-    clust,
-    insin,
-    hklin,
-) = ml_plots.readpickle()
+projname = ml_plots.readconfig()["projname"]
 
 
 if os.path.exists(os.path.join(path, projname)):
@@ -29,13 +19,18 @@ if os.path.exists(os.path.join(path, projname)):
 else:
     sys.exit()
 
-if os.path.exists(os.path.join(path, projname + "_results")):
-    to_run_ML = ml_plots.for_ML_analysis()
-    pool.starmap(ml_plots.plot_for_ML, to_run_ML)
+if os.path.exists(ml_plots.trials_file()):
+    trials = ml_plots.load_results()
 else:
-    to_run = ml_plots.cleanup_prev()
-    pool.starmap(ml_plots.results, to_run)
-    to_run_ML = ml_plots.for_ML_analysis()
-    pool.starmap(ml_plots.plot_for_ML, to_run_ML)
+    to_run, to_run_prasa = ml_plots.cleanup_prev()
+    ml_plots.write_results(pool.starmap(sagasu_core.parse_cell, to_run))
+    trials = ml_plots.load_results()
+# the explorer marks the best cells of the last analysis, if there was one
+ranking = None
+ranking_file = os.path.join(path, projname + "_results", "ranking.csv")
+if os.path.exists(ranking_file):
+    ranking = pd.read_csv(ranking_file)
+ml_plots.plot_mode = "cells"
+ml_plots.plot_ML(pool, trials, ranking=ranking)
 
 print("ML plots generated")
\ No newline at end of file
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ranking of grid cells for sagasu.
+
+A scorer takes the summary tables of a finished grid (what analysis leaves in
+<proj>_results) and a dict of weights, and returns one row per cell with a
+score column. SCORERS holds the ones sagasu ships, new ones are added there.
+Only the best rows are ever sorted, so a grid (or several) is re-scored under
+a new weighting straight from disk without running the analysis again:
+
+python sagasu_ranking.py                          joint score of the grid here
+python sagasu_ranking.py run1 run2 run3 --top 20  several datasets at once
+python sagasu_ranking.py --score ccall --mad-weights 1 2 4 8 16 32
+python sagasu_ranking.py --score joint --joint-weights prasa=1 agreement=2
+"""
+import argparse
+import functools
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+
+# trials further than k * MAD above the median count as outliers, weighted
+# by how far out they are when cells are scored
+MAD_MULTIPLIERS = (5, 6, 7, 8, 9, 10)
+MAD_WEIGHTS = (1, 4, 8, 32, 128, 512)
+MAD_NAMES = ["res", "sites"] + ["mad" + str(k) for k in MAD_MULTIPLIERS]
+# CFOM less res^2 and 0.3 per site, small cells at high resolution first
+CFOM_WEIGHTS = {"res": 1.0, "sites": 0.3}
+CFOM_NAMES = ["res", "sites", "CFOM", "PATFOM"]
+# how much each normalised term counts in the joint SHELXD + PRASA score
+JOINT_WEIGHTS = {"shelxd": 1.0, "cfom": 0.5, "prasa": 0.5, "agreement": 1.0}
+
+
+def mad_score(df, weights=MAD_WEIGHTS):
+    # one matrix product over the mad5..mad10 columns
+    counts = df[MAD_NAMES[2:]].to_numpy()
+    return pd.Series(counts @ np.asarray(weights), index=df.index)
+
+
+def cfom_score(df, weights=CFOM_WEIGHTS):
+    return df["CFOM"] - weights["res"] * df["res"] ** 2 - weights["sites"] * df["sites"]
+
+
+def normalise(values):
+    top = values.max()
+    return values / top if top > 0 else values * 0
+
+
+def top_k(df, column, k=10):
+    # the k largest rows, in the order a stable descending sort would give,
+    # found with a partition so only those k are ever sorted
+    values = df[column].to_numpy()
+    if len(values) > k:
+        kth = np.partition(values, len(values) - k)[len(values) - k]
+        above = np.flatnonzero(values > kth)
+        tied = np.flatnonzero(values == kth)[: k - len(above)]
+        best = np.concatenate((above, tied))
+    else:
+        best = np.arange(len(values))
+    return df.iloc[best[np.lexsort((best, -values[best]))]]
+
+
+def joint_scores(
+    ccall,
+    ccweak,
+    cfom,
+    prasa,
+    agreement=None,
+    weights=JOINT_WEIGHTS,
+    mad_weights=MAD_WEIGHTS,
+):
+    # one row per cell with its SHELXD summaries next to the PRASA run at the
+    # same resolution, and agreement[(res, sites)] the fraction of sites the
+    # two substructures share, in grid order
+    ranking = ccall[["res", "sites"]].copy()
+    ranking["ccall_score"] = mad_score(ccall, mad_weights).to_numpy()
+    ranking["ccweak_score"] = mad_score(ccweak, mad_weights).to_numpy()
+    ranking["key"] = (ranking["res"] * 10).round().astype(int)
+    cfom = cfom.assign(key=(cfom["res"] * 10).round().astype(int))
+    ranking = ranking.merge(
+        cfom[["key", "sites", "CFOM", "PATFOM"]], on=["key", "sites"], how="left"
+    )
+    best = (
+        prasa.assign(key=(prasa["res"] * 10).round().astype(int))
+        .groupby("key")
+        .agg(prasa_CC=("CC", "max"), prasa_candidates=("candidate", "sum"))
+    )
+    ranking = ranking.merge(best, left_on="key", right_index=True, how="left")
+    ranking = ranking.fillna({"CFOM": 0, "PATFOM": 0, "prasa_CC": 0})
+    ranking["prasa_candidates"] = ranking["prasa_candidates"].fillna(0).astype(int)
+    agreement = agreement or {}
+    ranking["agreement"] = [
+        agreement.get((key, sites), 0.0)
+        for key, sites in zip(ranking["key"], ranking["sites"])
+    ]
+    ranking["score"] = (
+        weights["shelxd"] * normalise(ranking["ccall_score"] + ranking["ccweak_score"])
+        + weights["cfom"] * normalise(ranking["CFOM"])
+        + weights["prasa"] * normalise(ranking["prasa_CC"])
+        + weights["agreement"] * ranking["agreement"]
+    )
+    return ranking.drop(columns="key")
+
+
+def joint_ranking(
+    ccall,
+    ccweak,
+    cfom,
+    prasa,
+    agreement=None,
+    weights=JOINT_WEIGHTS,
+    mad_weights=MAD_WEIGHTS,
+):
+    # every cell, best first, as written to ranking.csv
+    ranking = joint_scores(ccall, ccweak, cfom, prasa, agreement, weights, mad_weights)
+    ranking = ranking.sort_values("score", ascending=False, kind="stable")
+    return ranking.reset_index(drop=True)
+
+
+def score_ccall(tables, weights):
+    ccall = tables["ccall"]
+    return ccall.assign(score=mad_score(ccall, weights.get("mad", MAD_WEIGHTS)))
+
+
+def score_ccweak(tables, weights):
+    ccweak = tables["ccweak"]
+    return ccweak.assign(score=mad_score(ccweak, weights.get("mad", MAD_WEIGHTS)))
+
+
+def score_cfom(tables, weights):
+    cfom = tables["cfom"]
+    return cfom.assign(score=cfom_score(cfom, weights.get("cfom", CFOM_WEIGHTS)))
+
+
+def score_joint(tables, weights):
+    return joint_scores(
+        tables["ccall"],
+        tables["ccweak"],
+        tables["cfom"],
+        tables["prasa"],
+        tables["agreement"],
+        weights.get("joint", JOINT_WEIGHTS),
+        weights.get("mad", MAD_WEIGHTS),
+    )
+
+
+SCORERS = {
+    "ccall": score_ccall,
+    "ccweak": score_ccweak,
+    "cfom": score_cfom,
+    "joint": score_joint,
+}
+
+
+def res_header(filename):
+    # TITL, CELL and space group of a SHELXD .res, parsed once for as long
+    # as the file is unchanged
+    stat = os.stat(filename)
+    return read_res_header(os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=4096)
+def read_res_header(filename, mtime, size):
+    header = {}
+    with open(filename) as f:
+        for line in f:
+            words = line.split()
+            if not words:
+                continue
+            if words[0] == "TITL":
+                header["title"] = line[4:].strip()
+                header["spacegroup"] = words[-1]
+            elif words[0] == "CELL":
+                header["cell"] = " ".join(words[2:8])
+            elif words[0] == "UNIT":
+                # atoms from here on
+                break
+    return header
+
+
+def load_tables(path):
+    # the summaries a finished run left in <path>/<proj>_results, the
+    # agreement column of a previous ranking.csv is reused as it is
+    with open(os.path.join(path, "sagasu.json")) as f:
+        projname = json.load(f)["projname"]
+    results = os.path.join(path, projname + "_results")
+    tables = {
+        "projname": projname,
+        "ccall": pd.read_csv(os.path.join(results, "ccall.csv"), names=MAD_NAMES),
+        "ccweak": pd.read_csv(os.path.join(results, "ccweak.csv"), names=MAD_NAMES),
+        "cfom": pd.read_csv(os.path.join(results, "CFOM_PATFOM.csv"), names=CFOM_NAMES),
+        "prasa": pd.DataFrame(columns=["res", "CC", "candidate"]),
+        "agreement": {},
+    }
+    if os.path.exists(os.path.join(results, "prasa.csv")):
+        tables["prasa"] = pd.read_csv(os.path.join(results, "prasa.csv"))
+    if os.path.exists(os.path.join(results, "ranking.csv")):
+        previous = pd.read_csv(os.path.join(results, "ranking.csv"))
+        tables["agreement"] = {
+            (int(round(res * 10)), int(sites)): agreement
+            for res, sites, agreement in zip(
+                previous["res"], previous["sites"], previous["agreement"]
+            )
+            if agreement
+        }
+    return tables
+
+
+def rank_datasets(paths, scorer="joint", weights=None, top=10):
+    # the best cells over every dataset. Scores that are normalised (joint)
+    # are normalised within each dataset, so the best cell of each scores
+    # alike and weak datasets do not hide behind strong ones
+    scored = []
+    for path in paths:
+        tables = load_tables(path)
+        cells = SCORERS[scorer](tables, weights or {})
+        cells.insert(0, "dataset", tables["projname"])
+        cells["path"] = path
+        scored.append(cells)
+    best = top_k(pd.concat(scored, ignore_index=True), "score", top)
+    spacegroups = []
+    for path, projname, res, sites in zip(
+        best["path"], best["dataset"], best["res"], best["sites"]
+    ):
+        res_file = os.path.join(
+            path,
+            projname,
+            str(int(round(res * 10))),
+            str(int(sites)),
+            projname + "_fa.res",
+        )
+        header = res_header(res_file) if os.path.exists(res_file) else {}
+        spacegroups.append(header.get("spacegroup", ""))
+    return best.drop(columns="path").assign(spacegroup=spacegroups)
+
+
+def weight_pairs(pairs):
+    # name=value on the command line
+    return {name: float(value) for name, value in (p.split("=") for p in pairs)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("paths", nargs="*", default=["."], help="dataset directories")
+    parser.add_argument("--score", choices=sorted(SCORERS), default="joint")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument(
+        "--mad-weights", type=float, nargs=len(MAD_MULTIPLIERS), help="mad5..mad10"
+    )
+    parser.add_argument("--cfom-weights", nargs="+", help="eg. res=1 sites=0.3")
+    parser.add_argument("--joint-weights", nargs="+", help="eg. shelxd=1 prasa=0.5")
+    args = parser.parse_args()
+    weights = {}
+    if args.mad_weights:
+        weights["mad"] = args.mad_weights
+    if args.cfom_weights:
+        weights["cfom"] = dict(CFOM_WEIGHTS, **weight_pairs(args.cfom_weights))
+    if args.joint_weights:
+        weights["joint"] = dict(JOINT_WEIGHTS, **weight_pairs(args.joint_weights))
+    start = time.perf_counter()
+    best = rank_datasets(
+        [os.path.abspath(p) for p in args.paths], args.score, weights, args.top
+    )
+    elapsed = time.perf_counter() - start
+    print(best.to_string(index=False))
+    print(f"\nRe-scored {len(args.paths)} dataset(s) in {elapsed * 1000:.0f} ms")
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Report pages for sagasu.
+
+The summary page is streamed to disk section by section from templates,
+tables straight from the results in memory, big artefacts (the EMMA output,
+the per-cell figures) linked or lazily loaded rather than inlined.
+
+The explorer is one static page with every cell's trials embedded as a
+compact payload. Nothing is drawn until a cell is opened, the browser then
+draws its CCall vs CCweak scatter on a canvas and keeps it for the next
+time, so the analysis does not have to render figures nobody looks at.
+"""
+import base64
+import html
+import json
+import os
+import numpy as np
+
+# most trials any cell puts in the page, the strongest are always kept
+EXPLORER_POINTS = 4000
+# per-cell figures per collapsible page of the summary
+REPORT_PAGE = 100
+
+
+def fill(template, **values):
+    # plain replacement, the templates are full of CSS and JS braces
+    for name, value in values.items():
+        template = template.replace("{" + name + "}", str(value))
+    return template
+
+
+def thin(cell, max_points=EXPLORER_POINTS):
+    # indices of the trials to keep: the strongest half of the budget by
+    # CCall + CCweak, the rest spread evenly over the remainder
+    if len(cell) <= max_points:
+        return np.arange(len(cell))
+    strength = np.asarray(cell["CCALL"]) + np.asarray(cell["CCWEAK"])
+    top = np.argpartition(-strength, max_points // 2)[: max_points // 2]
+    rest = np.setdiff1d(np.arange(len(cell)), top)
+    rest = rest[np.linspace(0, len(rest) - 1, max_points - len(top)).astype(int)]
+    return np.sort(np.concatenate((top, rest)))
+
+
+def explorer_payload(cells, ranking, max_points=EXPLORER_POINTS):
+    # cells as (trials, res, sites). CCs are stored x10 as little-endian
+    # int16 pairs (CCweak, CCall), base64 encoded, which is exact for the one
+    # decimal SHELXD prints
+    scores = {
+        (int(round(res * 10)), int(sites)): row
+        for res, sites, row in zip(
+            ranking["res"], ranking["sites"], ranking.to_dict("records")
+        )
+    }
+    payload = {"cells": [], "columns": list(ranking.columns)}
+    for cell, i, j in cells:
+        keep = thin(cell, max_points)
+        xy = np.column_stack(
+            (np.asarray(cell["CCWEAK"])[keep], np.asarray(cell["CCALL"])[keep])
+        )
+        payload["cells"].append(
+            {
+                "res": i / 10,
+                "sites": j,
+                "trials": len(cell),
+                "xy": base64.b64encode(
+                    np.round(xy * 10).astype("<i2").tobytes()
+                ).decode(),
+                "summary": scores.get((i, j), {}),
+            }
+        )
+    return payload
+
+
+def write_explorer(filename, title, payload):
+    # json.dumps output can not close the script element once "</" is escaped
+    data = json.dumps(payload, default=float).replace("</", "<\\/")
+    with open(filename, "w") as f:
+        f.write(fill(EXPLORER_TEMPLATE, title=title, payload=data))
+
+
+def write_report(filename, run, hits, ranking=None, figures=None, page=REPORT_PAGE):
+    # hits is what core.tophits returns, figures what core.plot_ML returns,
+    # paths relative to the page. Written to a temporary file first so a half written page never
+    # replaces the last good one
+    esc = html.escape
+    figures = figures or {}
+    cells = figures.get("cells", [])
+    tmp = filename + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(
+            fill(
+                REPORT_HEAD,
+                projname=esc(run.projname),
+                ntry=run.ntry,
+                lowres=float(run.lowres / 10),
+                highres=float(run.highres / 10),
+                lowsites=run.lowsites,
+                highsites=run.highsites,
+            )
+        )
+        if ranking is not None and len(ranking):
+            f.write(fill(REPORT_TABLE, heading="SHELXD and PRASA ranked together"))
+            ranking.head(10).to_html(f, index=False)
+        for key in ("ccall", "ccweak", "cfom"):
+            f.write(fill(REPORT_TABLE, heading="For " + key.upper() + ":"))
+            hits[key].reset_index(drop=True).to_html(f)
+        if hits.get("emma"):
+            f.write(
+                fill(
+                    REPORT_EMMA,
+                    models=esc(hits["emma_models"]),
+                    emma=esc(hits["emma"]),
+                )
+            )
+        f.write(REPORT_PLOTS)
+        for surface in hits.get("surfaces", ()):
+            f.write(fill(REPORT_SURFACE, src=esc(surface)))
+        if figures.get("tiled"):
+            f.write(fill(REPORT_TILED, src=esc(figures["tiled"])))
+        for start in range(0, len(cells), page):
+            batch = cells[start : start + page]
+            # only the first page is open, the browser fetches nothing in a
+            # closed one
+            f.write(
+                fill(
+                    REPORT_PAGE_START,
+                    open=" open" if start == 0 else "",
+                    first=start + 1,
+                    last=start + len(batch),
+                    total=len(cells),
+                )
+            )
+            for figure in batch:
+                f.write(fill(REPORT_FIGURE, src=esc(figure)))
+            f.write("</div></details>\n")
+        f.write(REPORT_TAIL)
+    os.replace(tmp, filename)
+
+
+REPORT_HEAD = """<!doctype html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Sagasu - {projname}</title>
+<style>
+body { font-family: courier new, courier, monospace; margin: 1em; }
+h1 { text-align: center; }
+table.dataframe { border-collapse: collapse; margin-bottom: 1em; }
+table.dataframe td, table.dataframe th { padding: 0 6px; }
+.figures { display: flex; flex-wrap: wrap; gap: 4px; }
+.figures img { border: 2px solid #000; width: 420px; height: 320px; }
+img.surface { border: 2px solid #000; width: 768px; height: 576px; }
+</style>
+</head>
+<body>
+<h1>Sagasu - SHELXD Grid Search</h1>
+<p>Results for project <strong>{projname}</strong>, <strong>{ntry}</strong> trys with a low resolution limit of <strong>{lowres}</strong> and a high resolution limit of <strong>{highres}</strong>, searching for a number of sites between <strong>{lowsites}</strong> and <strong>{highsites}</strong>.</p>
+<hr />
+<p><a href="./{projname}_figures/vectoroutliers.html">Vector Outliers Overview</a></p>
+<p><a href="./{projname}_figures/emmamatrix.html">Phenix EMMA Correlation Heatmap</a></p>
+<p><a href="./{projname}_figures/{projname}_explorer.html">Grid Explorer</a></p>
+<hr />
+<p style="font-size: 18px;"><strong><u>Here are the top 10 hits:</u></strong></p>
+"""
+
+REPORT_TABLE = """<p><strong>{heading}</strong></p>
+"""
+
+REPORT_EMMA = """<hr />
+<p>phenix.emma of the top two CCALL cells:</p>
+<p style="white-space: pre-line;">{models}</p>
+<p><a href="./{emma}">phenix.emma output</a></p>
+"""
+
+REPORT_PLOTS = """<hr />
+<p style="font-size: 18px;"><strong><u>Plots:</u></strong></p>
+"""
+
+REPORT_SURFACE = """<img class="surface" src="{src}" title="{src}" loading="lazy" />
+"""
+
+REPORT_TILED = """<p><a href="{src}">Every cell on one figure</a></p>
+"""
+
+REPORT_PAGE_START = """<details{open}><summary>Figures {first} - {last} of {total}</summary>
+<div class="figures">
+"""
+
+REPORT_FIGURE = """<img src="{src}" title="{src}" loading="lazy" width="420" height="320" />
+"""
+
+REPORT_TAIL = """</body>
+</html>
+"""
+
+
+EXPLORER_TEMPLATE = """<!doctype html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Sagasu - {title}</title>
+<style>
+body { font-family: courier new, courier, monospace; margin: 1em; }
+#grid { border-collapse: collapse; }
+#grid td { width: 28px; height: 20px; cursor: pointer; border: 1px solid #fff; }
+#grid th { font-size: 11px; font-weight: normal; padding: 0 3px; }
+#grid td.open { outline: 2px solid #000; }
+#panel { display: flex; gap: 2em; margin-top: 1em; }
+#summary td { padding: 0 8px; }
+</style>
+</head>
+<body>
+<h2>Sagasu - {title}</h2>
+<p>Colour by <select id="metric"></select> - click a cell to plot its trials</p>
+<table id="grid"></table>
+<div id="panel">
+<canvas id="plot" width="640" height="480"></canvas>
+<table id="summary"></table>
+</div>
+<script id="payload" type="application/json">{payload}</script>
+<script>
+const data = JSON.parse(document.getElementById("payload").textContent);
+const cells = data.cells;
+const drawn = new Map();
+const metric = document.getElementById("metric");
+const grid = document.getElementById("grid");
+const plot = document.getElementById("plot");
+const ctx = plot.getContext("2d");
+const key = (c) => c.res.toFixed(1) + "_" + c.sites;
+const byKey = new Map(cells.map((c) => [key(c), c]));
+const res = [...new Set(cells.map((c) => c.res))].sort((a, b) => a - b);
+const sites = [...new Set(cells.map((c) => c.sites))].sort((a, b) => b - a);
+
+for (const m of data.columns.filter((m) => !["res", "sites"].includes(m))) {
+  metric.add(new Option(m, m, m === "score", m === "score"));
+}
+
+function colour(v, lo, hi) {
+  const t = hi > lo ? (v - lo) / (hi - lo) : 0;
+  return `hsl(${240 - 240 * t}, 80%, ${85 - 40 * t}%)`;
+}
+
+function drawGrid() {
+  const values = cells.map((c) => Number(c.summary[metric.value] || 0));
+  const lo = Math.min(...values), hi = Math.max(...values);
+  let html = "<tr><th>sites \\\\ res</th>" + res.map((r) => `<th>${r.toFixed(1)}</th>`).join("") + "</tr>";
+  for (const s of sites) {
+    html += `<tr><th>${s}</th>`;
+    for (const r of res) {
+      const c = byKey.get(r.toFixed(1) + "_" + s);
+      const v = c ? Number(c.summary[metric.value] || 0) : null;
+      html += c
+        ? `<td data-key="${key(c)}" title="${key(c)}: ${v}" style="background:${colour(v, lo, hi)}"></td>`
+        : "<td></td>";
+    }
+    html += "</tr>";
+  }
+  grid.innerHTML = html;
+}
+
+function points(c) {
+  const bytes = Uint8Array.from(atob(c.xy), (ch) => ch.charCodeAt(0));
+  return new Int16Array(bytes.buffer);
+}
+
+function render(c) {
+  // drawn once per cell, later visits reuse the bitmap
+  const xy = points(c);
+  let x0 = Infinity, x1 = -Infinity, y0 = Infinity, y1 = -Infinity;
+  for (let n = 0; n < xy.length; n += 2) {
+    x0 = Math.min(x0, xy[n]); x1 = Math.max(x1, xy[n]);
+    y0 = Math.min(y0, xy[n + 1]); y1 = Math.max(y1, xy[n + 1]);
+  }
+  const pad = 40, w = plot.width - 2 * pad, h = plot.height - 2 * pad;
+  const sx = w / Math.max(x1 - x0, 1), sy = h / Math.max(y1 - y0, 1);
+  ctx.fillStyle = "#fff";
+  ctx.fillRect(0, 0, plot.width, plot.height);
+  ctx.strokeStyle = "#000";
+  ctx.strokeRect(pad, pad, w, h);
+  ctx.fillStyle = "#000";
+  ctx.fillText(`CCweak ${(x0 / 10).toFixed(1)} - ${(x1 / 10).toFixed(1)}`, pad, plot.height - 12);
+  ctx.fillText(`CCall ${(y0 / 10).toFixed(1)} - ${(y1 / 10).toFixed(1)}`, pad, 24);
+  ctx.fillText(`${key(c)}, ${xy.length / 2} of ${c.trials} trials`, plot.width - 260, 24);
+  ctx.fillStyle = "rgba(31, 119, 180, 0.6)";
+  for (let n = 0; n < xy.length; n += 2) {
+    ctx.fillRect(pad + (xy[n] - x0) * sx - 1.5, pad + h - (xy[n + 1] - y0) * sy - 1.5, 3, 3);
+  }
+  return ctx.getImageData(0, 0, plot.width, plot.height);
+}
+
+function show(k) {
+  const c = byKey.get(k);
+  if (!c) return;
+  if (!drawn.has(k)) drawn.set(k, render(c));
+  ctx.putImageData(drawn.get(k), 0, 0);
+  document.getElementById("summary").innerHTML = Object.entries(c.summary)
+    .map(([name, v]) => `<tr><td>${name}</td><td>${typeof v === "number" ? +v.toFixed(3) : v}</td></tr>`)
+    .join("");
+  for (const td of grid.querySelectorAll("td.open")) td.classList.remove("open");
+  const td = grid.querySelector(`td[data-key="${k}"]`);
+  if (td) td.classList.add("open");
+  history.replaceState(null, "", "#" + k);
+}
+
+grid.addEventListener("click", (e) => e.target.dataset.key && show(e.target.dataset.key));
+metric.addEventListener("change", () => { drawGrid(); show(location.hash.slice(1)); });
+drawGrid();
+show(location.hash.slice(1) || (cells.length ? key(cells.reduce((a, b) =>
+  Number(b.summary.score || 0) > Number(a.summary.score || 0) ? b : a)) : ""));
+</script>
+</body>
+</html>
+"""
@@ -18,4 +18,20 @@ def get_slurm_token():
     client.close()
     return user, token
 
-user, token = get_slurm_token()
\ No newline at end of file
+
+if __name__ == "__main__":
+    # the token is good for 3 days, it never goes to stdout (and the logs).
+    # With a filename it is written there, readable by the user only
+    import sys
+
+    user, token = get_slurm_token()
+    if token is None:
+        sys.exit(f"No SLURM_JWT for {user}")
+    if len(sys.argv) > 1:
+        fd = os.open(sys.argv[1], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(token + "\n")
+        print(f"SLURM_JWT for {user} written to {sys.argv[1]}")
+    else:
+        print(f"Got a SLURM_JWT for {user}")
\ No newline at end of file